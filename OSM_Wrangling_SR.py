@@ -23,14 +23,62 @@
 # In[1]:
 
 import xml.etree.cElementTree as ET
-from collections import defaultdict
+import xml.parsers.expat as expat
+try:
+    import lxml.etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+from collections import defaultdict, OrderedDict
 import re
 import pprint
 import codecs
 import csv
 import sqlite3
 import pandas as pd
+import numpy as np
 import os
+import json
+import bisect
+import hashlib
+import cPickle as pickle
+import types
+from distutils.version import LooseVersion
+try:
+    from pandas.core.internals import BlockManager, make_block
+except ImportError:
+    BlockManager = make_block = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+import multiprocessing
+import urllib
+import urllib2
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import threading
+import Queue
+import zlib
+import tempfile
+import bz2
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+import math
+import time
+import random
+import cProfile
+import pstats
+from contextlib import contextmanager
+import sys
+import platform
+from xml.sax.saxutils import quoteattr
 import matplotlib.pyplot as plt
 import seaborn as sb
 
@@ -42,17 +90,648 @@ print "file {!r} is {!s} MB".format("pittsburgh_pennsylvania.osm",round(os.path.
 pittsburgh = open(osm_file,"r")
 
 
+# Every function below needs to loop through the whole XML file, and the file is more than 400 MB. Instead of letting each function open the file and run its own **iterparse**, we define a small single pass engine. Each piece of work (counting tags, auditing, building a table) is written as a "visitor": an object that says which tags it is interested in, gets every matching element through its **visit()** method and hands back its **result()** at the end. **run_pass()** parses the file once and feeds every element to all the registered visitors, so we can get all the results together from a single scan. Elements are handed to the visitors on their "end" event, when all their children are parsed, and are cleared right after that, which keeps the memory flat no matter how big the file is. 
+
+# In[ ]:
+
+class Visitor(object):
+    # element tags this visitor wants to see, None means every element
+    tags = None
+    def visit(self, elem):
+        pass
+    def result(self):
+        return None
+    # a new visitor with the same settings and no results yet (used to run it on a shard)
+    def empty(self):
+        raise NotImplementedError("{} can not run on shards".format(type(self).__name__))
+    # adds the results that another visitor collected on a different part of the file
+    def merge(self, other):
+        raise NotImplementedError("{} can not run on shards".format(type(self).__name__))
+    # identifies what this visitor computes so its result can be cached, None means never cache it
+    def cache_key(self):
+        return None
+
+def add_counts(dct, other):
+    for key, count in other.iteritems(): dct[key] += count
+
+def run_pass(visitors, filename=None, clear=True, visit_root=True, metrics=None, backend=None):
+    if filename is None: filename = osm_file
+    # look up the interested visitors per tag once instead of asking all of them for every element
+    by_tag = defaultdict(list)
+    catch_all = []
+    for visitor in (visitors if metrics is None else [TimedVisitor(visitor, metrics) for visitor in visitors]):
+        if visitor.tags is None: catch_all.append(visitor)
+        else:
+            for tag in visitor.tags: by_tag[tag].append(visitor)
+    # filename can also be an open file (or anything with a read() method)
+    source, size = (filename, None) if hasattr(filename, "read") else open_osm(filename)
+    if metrics is not None:
+        metrics.start_pass(size)
+        tell = getattr(source, "tell", lambda: None)
+        started, visited = time.time(), metrics.seconds("visit:")
+        if metrics.profiler is not None: metrics.profiler.enable()
+    try:
+        # without catch-all visitors the backend only has to hand over the tags somebody asked for
+        for depth, elem in parser_backend(backend)(source, clear, None if catch_all else set(by_tag)):
+            if depth == 0 and not visit_root: continue
+            for visitor in catch_all: visitor.visit(elem)
+            for visitor in by_tag.get(elem.tag, ()): visitor.visit(elem)
+            if metrics is not None and depth == 1:
+                metrics.elements += 1
+                if metrics.elements % 1000 == 0: metrics.progress(tell())
+    finally:
+        if metrics is not None:
+            if metrics.profiler is not None: metrics.profiler.disable()
+            # whatever was not spent in the visitors was spent parsing
+            visited = metrics.seconds("visit:") - visited
+            metrics.add_time("parse", time.time() - started - visited)
+            metrics.progress(tell())
+            metrics.flush()
+        if source is not filename: source.close()
+    return [visitor.result() for visitor in visitors]
+
+
+# **run_pass()** does not depend on how the XML is parsed: a **parser backend** is a generator that reads the file and yields **(depth, element)** for every element on its closing tag (depth 0 is the **<osm>** root, 1 a node, way or relation), and frees the top level elements once they have been visited. There are three of them. **etree** is the **cElementTree iterparse** loop we started with. **lxml** uses **lxml.etree.iterparse**, which can filter the tags in C, so when no visitor asks for every element only the elements that were asked for come back to Python. **expat** skips the Element objects altogether: an expat handler builds small **OsmElement** records (a tag, a dict of attributes and a list of children, in **__slots__**), which offer the part of the Element interface the visitors use (**attrib**, **get()**, **iter()** and **clear()**). On our synthetic file lxml is the fastest; the expat handler runs Python code for every element, so on CPython it is only about as fast as cElementTree, but it never builds a tree and with a tag filter the <tag> and <nd> records are not even handed back. The expat backend hands back every string as unicode, where cElementTree gives plain ASCII strings as str; in Python 2 the two compare and hash equal, so the tables come out the same. **run_pass(..., backend="expat")** picks one for a pass, and **xml_backend** sets the default: "auto" uses lxml when it is installed and cElementTree otherwise. **check_backends()** runs the same visitors with every available backend and checks that their results are identical.
+
+# In[ ]:
+
+# the top level elements of an OSM file
+osm_elements = ("node", "way", "relation")
+
+def etree_elements(source, clear=True, tags=None):
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None: root = elem
+            depth += 1
+            continue
+        depth -= 1
+        # on the "end" event all the <tag> and <nd> children have been parsed
+        yield depth, elem
+        # free every top level element (node, way, relation) once it is visited, together with
+        # the finished siblings still hanging from the root, so memory does not grow with the file
+        if clear and depth == 1:
+            elem.clear()
+            del root[:]
+
+def lxml_elements(source, clear=True, tags=None):
+    if lxml_etree is None: raise ImportError("backend='lxml' needs lxml")
+    if tags is None: events = lxml_etree.iterparse(source, events=("start", "end"))
+    # the top level tags always come back, otherwise the elements nobody asked for would never be freed
+    else: events = lxml_etree.iterparse(source, events=("end",), tag=sorted(set(tags) | set(osm_elements)))
+    depth = 0
+    for event, elem in events:
+        if event == "start":
+            depth += 1
+            continue
+        if tags is None: depth -= 1
+        else: depth = sum(1 for _ in elem.iterancestors())
+        yield depth, elem
+        if clear and depth == 1:
+            elem.clear()
+            while elem.getprevious() is not None: del elem.getparent()[0]
+
+class OsmElement(object):
+    __slots__ = ('tag', 'attrib', 'children')
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+    # like Element.iter(), the element itself comes first if it matches
+    def iter(self, tag=None):
+        found = [self] if tag is None or tag == self.tag else []
+        for child in self.children:
+            if child.children: found.extend(child.iter(tag))
+            elif tag is None or tag == child.tag: found.append(child)
+        return found
+    def __iter__(self):
+        return iter(self.children)
+    def __len__(self):
+        return len(self.children)
+    def clear(self):
+        self.attrib = {}
+        del self.children[:]
+
+def expat_elements(source, clear=True, tags=None, block=64*1024):
+    stack = []
+    done = []
+    def start(tag, attrib):
+        elem = OsmElement(tag, attrib)
+        if stack:
+            # with clear=True the top level elements are never attached to the root, so there is nothing to free
+            if len(stack) > 1 or not clear: stack[-1].children.append(elem)
+        stack.append(elem)
+    def end(tag):
+        elem = stack.pop()
+        depth = len(stack)
+        # the <tag>, <nd> and <member> children only go back to Python when somebody asked for them
+        if depth <= 1 or tags is None or tag in tags: done.append((depth, elem))
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    while True:
+        data = source.read(block)
+        parser.Parse(data, not data)
+        for item in done: yield item
+        del done[:]
+        if not data: break
+
+parser_backends = OrderedDict([("etree", etree_elements), ("lxml", lxml_elements), ("expat", expat_elements)])
+xml_backend = "auto"
+
+def parser_backend(name=None):
+    name = name or xml_backend
+    if name == "auto": name = "lxml" if lxml_etree is not None else "etree"
+    try:
+        return parser_backends[name]
+    except KeyError:
+        raise ValueError("unknown parser backend {!r}, expected one of {}".format(name, ", ".join(parser_backends)))
+
+def available_backends():
+    return [name for name in parser_backends if name != "lxml" or lxml_etree is not None]
+
+# runs fresh copies of the visitors with every backend and raises if any result differs from the etree one
+def check_backends(visitors, filename=None, compare=None):
+    compare = compare or (lambda a, b: a.equals(b) if isinstance(a, pd.DataFrame) else a == b)
+    results = OrderedDict((name, run_pass([visitor.empty() for visitor in visitors], filename, backend=name))
+                          for name in available_backends())
+    expected = results["etree"]
+    for name, result in results.iteritems():
+        for visitor, a, b in zip(visitors, expected, result):
+            if not compare(a, b):
+                raise AssertionError("{} gives a different result with backend {!r}".format(type(visitor).__name__, name))
+    return results.keys()
+
+
+# The extracts are distributed compressed (**.osm.bz2**, **.osm.gz**, **.osm.xz**) and the compressed file is several times smaller, so there is no need to decompress it to disk before every run. **open_osm()** recognises the compression from the first bytes of the file, not from its name, and returns a file-like **StreamReader** whose background thread reads the compressed file and decompresses it into a bounded queue of blocks, so decompression and parsing overlap and at most **buffered** blocks are held in memory (bz2 and zlib release the GIL while they work). Files made of several concatenated streams, like the ones written by pbzip2, are read to the end. The file name **"-"** reads the standard input, compressed or not, e.g. **curl ... | python OSM_Wrangling_SR.py** with **osm_file = "-"**. Every function that takes a **filename** goes through **open_osm()**, and **tell()** returns the number of compressed bytes read so far, so **Metrics** reports progress and the ETA against the size of the compressed file. Compressed files and the standard input can not be cut into byte ranges, so **run_sharded()** parses them in a single pass, and results read from the standard input are never cached. xz needs the **lzma** module (**backports.lzma** on Python 2). 
+
+# In[ ]:
+
+stdin_name = "-"
+compression_magic = [("\x1f\x8b", "gz"), ("BZh", "bz2"), ("\xfd7zXZ\x00", "xz")]
+
+def decompressor(kind):
+    if kind == "gz": return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if kind == "bz2": return bz2.BZ2Decompressor()
+    if kind == "xz":
+        if lzma is None: raise ImportError("xz input needs lzma (backports.lzma on Python 2)")
+        return lzma.LZMADecompressor()
+    raise ValueError("unknown compression {!r}".format(kind))
+
+def compression(head):
+    for magic, kind in compression_magic:
+        if head.startswith(magic): return kind
+    return None
+
+def is_streamed(filename):
+    # True when the file can not be read by byte ranges: the standard input or a compressed file
+    if filename == stdin_name: return True
+    with open(filename, "rb") as f:
+        return compression(f.read(6)) is not None
+
+class StreamReader(object):
+    # file-like reader over a raw stream, decompressed (kind None leaves it as it is) by a background thread
+    def __init__(self, raw, kind=None, head="", block=1024*1024, buffered=16):
+        self.raw = raw
+        self.kind = kind
+        self.head = head
+        self.block = block
+        self.consumed = 0
+        self.queue = Queue.Queue(buffered)
+        self.chunk = ""
+        self.pos = 0
+        self.done = False
+        self.stopped = False
+        self.error = None
+        self.thread = threading.Thread(target=self.produce)
+        self.thread.daemon = True
+        self.thread.start()
+    def decompress(self, data):
+        if self.kind is None: return [data]
+        out = []
+        while data:
+            try:
+                out.append(self.decompressor.decompress(data))
+            except EOFError:
+                # a new stream starts right where the last one ended
+                self.decompressor = decompressor(self.kind)
+                continue
+            data = self.decompressor.unused_data
+            if data: self.decompressor = decompressor(self.kind)
+        return out
+    def produce(self):
+        try:
+            if self.kind is not None: self.decompressor = decompressor(self.kind)
+            data = self.head
+            while data and not self.stopped:
+                self.consumed += len(data)
+                for chunk in self.decompress(data):
+                    if chunk: self.queue.put(chunk)
+                data = self.raw.read(self.block)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.queue.put(None)
+    def read(self, size=64*1024):
+        # returns at most size bytes, and "" only at the end of the stream
+        while self.pos >= len(self.chunk):
+            if self.done: return ""
+            chunk = self.queue.get()
+            if chunk is None:
+                self.done = True
+                if self.error is not None: raise self.error[0], self.error[1], self.error[2]
+                return ""
+            self.chunk, self.pos = chunk, 0
+        data = self.chunk[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+    def tell(self):
+        return self.consumed
+    def close(self):
+        self.stopped = True
+        # let the producer get past a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        if self.raw is not sys.stdin: self.raw.close()
+
+# returns (file, size in bytes of the file on disk or None for the standard input)
+def open_osm(filename, block=1024*1024, buffered=16):
+    if filename == stdin_name: raw, size = sys.stdin, None
+    else: raw, size = open(filename, "rb"), os.path.getsize(filename)
+    head = raw.read(6)
+    kind = compression(head)
+    if kind is None and raw is not sys.stdin:
+        raw.seek(0)
+        return raw, size
+    return StreamReader(raw, kind, head, block, buffered), size
+
+
+# On the full file a pass takes minutes and prints nothing until it is done. A **Metrics** object given to **run_pass()** (or **load_db()**) reports how many elements were processed and how many bytes of the file were read, with the rate and the time left, every **interval** seconds. It also times the stages of the pass: **parse** is the time spent in **iterparse** itself, **visit:<visitor>** the time spent in each visitor, and **load_db()** adds **clean**, **write**, **index** and the other steps of the loader. **instrument()** wraps a **TagCleaner** so every call of the cleaning functions (update_zipcode, clean_street_name, update_landuse) is counted and timed; since the cleaned values are memoized, only the first time a value is seen reaches them. With **profile=True** the pass also runs under **cProfile** and the functions with the highest cumulative time are kept. **to_json()** exports everything, and with **path** set the JSON file is rewritten at every report and, through **flush()**, at the end of every pass and of **load_db()**, so a scheduler can check that a long job is still moving and the last file holds the final numbers. For example **metrics = Metrics(path="metrics.json"); load_db('osm.db', replace=True, metrics=metrics)**. 
+
+# In[ ]:
+
+@contextmanager
+def timed_stage(metrics, name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        if metrics is not None: metrics.add_time(name, time.time() - start)
+
+class Metrics(object):
+    def __init__(self, interval=10.0, report=True, path=None, profile=False):
+        self.interval = interval
+        self.report = report
+        self.path = path
+        self.profiler = cProfile.Profile() if profile else None
+        # the writer thread of load_db adds to the stages and gauges while the main thread reads them
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.cleaners = OrderedDict()
+        self.gauges = OrderedDict()
+        self.elements = 0
+        self.position = 0
+        self.total_bytes = None
+        self.started = self.updated = self.reported = time.time()
+        self.pass_started = self.started
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+    def seconds(self, prefix=""):
+        # total time of the stages whose name starts with prefix
+        with self.lock: return sum(seconds for name, (_, seconds) in self.stages.iteritems() if name.startswith(prefix))
+    # keeps the last and the highest value of something that goes up and down, like the length of a queue
+    def gauge(self, name, value):
+        with self.lock:
+            gauge = self.gauges.setdefault(name, [value, value])
+            gauge[0] = value
+            gauge[1] = max(gauge[1], value)
+    def start_pass(self, total_bytes=None):
+        self.total_bytes = total_bytes
+        self.position = 0
+        self.pass_started = time.time()
+    def progress(self, position=None):
+        self.updated = time.time()
+        if position is not None: self.position = position
+        if self.updated - self.reported >= self.interval:
+            self.reported = self.updated
+            if self.report: print self.status()
+            self.flush()
+    def flush(self):
+        # rewrites the JSON file now, at the end of a pass or a stage, whatever the interval
+        if self.path is not None: self.to_json(self.path)
+    def eta(self):
+        # seconds left in the current pass, from the rate at which the file has been read so far
+        elapsed = time.time() - self.pass_started
+        if not self.total_bytes or not self.position or not elapsed: return None
+        return (self.total_bytes - self.position) / (self.position / elapsed)
+    def status(self):
+        elapsed = time.time() - self.started
+        line = "{:,} elements, {:,.0f} elements/s".format(self.elements, self.elements / elapsed if elapsed else 0)
+        if self.total_bytes:
+            line += ", {:.1f} of {:.1f} MB ({:.1f}%)".format(self.position / 1048576.0, self.total_bytes / 1048576.0,
+                                                           100.0 * self.position / self.total_bytes)
+        eta = self.eta()
+        if eta is not None: line += ", {:d}:{:02d} left".format(int(eta) // 60, int(eta) % 60)
+        with self.lock: gauges = [(name, value) for name, (value, _) in self.gauges.iteritems()]
+        for name, value in gauges: line += ", {} {}".format(name, value)
+        return line
+    def timed(self, func, name=None):
+        name = name or getattr(func, "__name__", repr(func))
+        counter = self.cleaners.setdefault(name, [0, 0.0])
+        def timed_func(*args):
+            start = time.time()
+            try:
+                return func(*args)
+            finally:
+                counter[0] += 1
+                counter[1] += time.time() - start
+        timed_func.memoize = getattr(func, "memoize", True)
+        return timed_func
+    def instrument(self, cleaner=None):
+        # a copy of the cleaner whose cleaning functions and clean() calls are timed
+        cleaner = cleaner or tag_cleaner
+        return TimedTagCleaner(self, dict((key, self.timed(func)) for key, func in cleaner.cleaners.iteritems()),
+                               cleaner.cache_size)
+    def profile_stats(self, top=20):
+        if self.profiler is None: return None
+        stats = pstats.Stats(self.profiler).stats
+        rows = sorted(stats.iteritems(), key=lambda item: -item[1][3])[:top]
+        return [OrderedDict([("function", "{}:{}({})".format(*func)), ("calls", calls), ("seconds", own), ("cumulative", cumulative)])
+                for func, (_, calls, own, cumulative, _) in rows]
+    def to_dict(self):
+        now = time.time()
+        with self.lock:
+            stages = [(name, tuple(stage)) for name, stage in self.stages.iteritems()]
+            gauges = [(name, tuple(gauge)) for name, gauge in self.gauges.iteritems()]
+        return OrderedDict([
+            ("elements", self.elements), ("bytes", self.position), ("total_bytes", self.total_bytes),
+            ("elapsed", now - self.started), ("since_update", now - self.updated), ("eta", self.eta()),
+            ("stages", OrderedDict((name, {"calls": calls, "seconds": seconds}) for name, (calls, seconds) in stages)),
+            ("cleaners", OrderedDict((name, {"calls": calls, "seconds": seconds, "mean_us": 1e6 * seconds / calls if calls else None})
+                                     for name, (calls, seconds) in self.cleaners.iteritems())),
+            ("gauges", OrderedDict((name, {"value": value, "max": peak}) for name, (value, peak) in gauges)),
+            ("profile", self.profile_stats())])
+    def to_json(self, path=None):
+        text = json.dumps(self.to_dict(), indent=1)
+        if path is None: return text
+        # write to a temporary file first, so a reader never sees half a file
+        with open(path + ".tmp", "w") as out: out.write(text)
+        if os.path.exists(path): os.remove(path)
+        os.rename(path + ".tmp", path)
+
+class TimedVisitor(object):
+    # stands in for a visitor in run_pass and adds up the time spent in its visit()
+    def __init__(self, visitor, metrics):
+        self.visitor = visitor
+        self.tags = visitor.tags
+        self.metrics = metrics
+        self.name = "visit:" + type(visitor).__name__
+    def visit(self, elem):
+        start = time.time()
+        self.visitor.visit(elem)
+        self.metrics.add_time(self.name, time.time() - start)
+
+
+# A single **iterparse** loop only uses one core. Since the top level elements of an OSM file are independent, we can also cut the file into byte ranges that start right at a **<node**, **<way** or **<relation** tag and parse each range in its own process. Every worker runs fresh copies of the visitors (including the audit and the update_* cleaners) on its shard, and the partial results are merged back in file order, so the output is the same as a single pass. For example **run_sharded([Auditor(street_types, invalid_zipcodes), UserCounter()], processes=4)**. 
+
+# In[ ]:
+
+element_start = re.compile(r'<(?:node|way|relation)[\s/>]')
+
+def find_shards(filename, shards, block=1024*1024):
+    # returns (start, end) byte ranges, every range except the first starts at a top level element
+    size = os.path.getsize(filename)
+    bounds = [0]
+    f = open(filename, "rb")
+    try:
+        for i in range(1, shards):
+            pos = max(size * i // shards, bounds[-1] + 1)
+            f.seek(pos)
+            tail = ""
+            while True:
+                data = f.read(block)
+                if not data: break
+                m = element_start.search(tail + data)
+                if m:
+                    start = pos - len(tail) + m.start()
+                    if start > bounds[-1]: bounds.append(start)
+                    break
+                # keep a few bytes in case a tag is cut in half by the block boundary
+                pos += len(data)
+                tail = data[-10:]
+            if not data: break
+    finally:
+        f.close()
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+class ShardReader(object):
+    # file-like view of filename[start:end] wrapped in its own <osm> root when needed
+    def __init__(self, filename, start, end, prefix="", suffix=""):
+        self.f = open(filename, "rb")
+        self.f.seek(start)
+        self.left = end - start
+        self.pieces = [prefix]
+        self.suffix = suffix
+    def read(self, size=64*1024):
+        while self.pieces and not self.pieces[0]: self.pieces.pop(0)
+        if not self.pieces:
+            if self.left > 0:
+                data = self.f.read(min(size, self.left))
+                self.left -= len(data)
+                if data: return data
+                self.left = 0
+            if self.suffix:
+                self.pieces.append(self.suffix)
+                self.suffix = ""
+                return self.read(size)
+            return ""
+        data = self.pieces[0][:size]
+        self.pieces[0] = self.pieces[0][size:]
+        return data
+    def close(self):
+        self.f.close()
+
+def parse_shard(job):
+    filename, start, end, first, last, visitors, backend = job
+    # the first shard has the real <osm> root, the others get a fake one that must not be visited
+    reader = ShardReader(filename, start, end, "" if first else "<osm>", "" if last else "</osm>")
+    try:
+        run_pass(visitors, reader, visit_root=first, backend=backend)
+    finally:
+        reader.close()
+    return visitors
+
+def run_sharded(visitors, filename=None, processes=None, shards=None, backend=None):
+    if filename is None: filename = osm_file
+    if is_streamed(filename): return run_pass(visitors, filename, backend=backend)
+    if processes is None: processes = multiprocessing.cpu_count()
+    if shards is None: shards = processes
+    ranges = find_shards(filename, shards)
+    jobs = [(filename, start, end, i == 0, i == len(ranges) - 1, [visitor.empty() for visitor in visitors], backend)
+            for i, (start, end) in enumerate(ranges)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        # map keeps the shards in file order, so merging is deterministic
+        parts = pool.map(parse_shard, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    for part in parts:
+        for visitor, other in zip(visitors, part): visitor.merge(other)
+    return [visitor.result() for visitor in visitors]
+
+
+# While exploring the data we call the same counting functions over and over on a file that does not change. **ResultCache** keeps their results on disk, under a key made of the file (its path, size and modification time, or the hash of its content with **use_hash=True**) and of the visitor (its class, the code of its **visit()** method and e.g. the predicate given to **unique_features()**, with its defaults, the values of its closure and the globals it reads). A predicate that is not a plain function, or that reads something without a stable representation, is never cached. If the file or the code changes the key changes too, so stale results are never returned. When the cache grows over **max_bytes** the least recently used results are removed. 
+
+# In[ ]:
+
+def code_id(func):
+    # the bytecode, names and constants of a function, so editing it gives a new id
+    code = getattr(func, "__func__", func).__code__
+    consts = [c for c in code.co_consts if not hasattr(c, "co_code")]
+    return hashlib.sha1(code.co_code + repr((code.co_names, consts))).hexdigest()
+
+class Unhashable(Exception):
+    pass
+
+def value_id(value, seen):
+    # a repr of the value that only depends on its content, raises Unhashable when there is no such repr
+    if value is None or isinstance(value, (bool, int, long, float, basestring)): return repr(value)
+    if isinstance(value, (tuple, list)): return type(value).__name__ + repr([value_id(v, seen) for v in value])
+    if isinstance(value, (set, frozenset)): return type(value).__name__ + repr(sorted(value_id(v, seen) for v in value))
+    if isinstance(value, dict): return "dict" + repr(sorted((value_id(k, seen), value_id(v, seen)) for k, v in value.iteritems()))
+    if isinstance(value, types.ModuleType): return "module " + value.__name__
+    if isinstance(value, type(re.compile(""))): return "re " + repr((value.pattern, value.flags))
+    if isinstance(value, types.FunctionType):
+        if value in seen: return "function " + value.__name__
+        return function_id(value, seen)
+    raise Unhashable(repr(value))
+
+def function_id(func, seen=None):
+    # code_id plus everything else the function reads: its defaults, the values of its closure
+    # and the globals it refers to, so e.g. two predicates built by the same factory get different ids
+    if not isinstance(func, types.FunctionType): raise Unhashable(repr(func))
+    seen = (seen or set()) | set([func])
+    code = func.__code__
+    globs = func.__globals__
+    parts = [code_id(func), value_id(func.__defaults__, seen),
+             value_id([cell.cell_contents for cell in func.__closure__ or ()], seen),
+             repr([(name, value_id(globs[name], seen)) for name in code.co_names if name in globs])]
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+# the id of a predicate for a cache key, None when its results should not be cached
+def predicate_id(func):
+    try:
+        return function_id(func)
+    except (Unhashable, ValueError):
+        return None
+
+class ResultCache(object):
+    def __init__(self, directory=".osm_cache", max_bytes=512*1024*1024, use_hash=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.use_hash = use_hash
+        self.hashes = {}
+    def file_id(self, filename):
+        st = os.stat(filename)
+        stamp = (os.path.abspath(filename), st.st_size, st.st_mtime)
+        if not self.use_hash: return stamp
+        # hashing a big file takes a while, so it is only done once per size and modification time
+        if stamp not in self.hashes:
+            sha = hashlib.sha1()
+            with open(filename, "rb") as f:
+                for block in iter(lambda: f.read(1024*1024), ""): sha.update(block)
+            self.hashes[stamp] = (sha.hexdigest(), st.st_size)
+        return self.hashes[stamp]
+    def path(self, filename, key):
+        name = hashlib.sha1(repr((self.file_id(filename), key))).hexdigest()
+        return os.path.join(self.directory, name + ".pkl")
+    def get(self, path):
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path, None)
+        return value
+    def put(self, path, value):
+        if not os.path.isdir(self.directory): os.makedirs(self.directory)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        self.evict()
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pkl"):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes: break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory): os.remove(os.path.join(self.directory, name))
+
+result_cache = ResultCache()
+
+def cached_pass(visitors, filename=None, cache=None):
+    # like run_pass, but the results of cacheable visitors are read from the cache when possible
+    if filename is None: filename = osm_file
+    if filename == stdin_name: return run_pass(visitors, filename)
+    if cache is None: cache = result_cache
+    results = [None] * len(visitors)
+    paths = {}
+    todo = []
+    for i, visitor in enumerate(visitors):
+        key = visitor.cache_key()
+        if key is not None:
+            paths[i] = cache.path(filename, key)
+            hit = cache.get(paths[i])
+            if hit is not None:
+                results[i] = hit[0]
+                continue
+        todo.append(i)
+    if todo:
+        for i, result in zip(todo, run_pass([visitors[i] for i in todo], filename)):
+            results[i] = result
+            if i in paths: cache.put(paths[i], (result,))
+    return results
+
+
 # Now we write a function to see what the unique tags are in this XML file. The following function shows all the unique tags found in our dataset and their frequency. After running the function, we can see that **osm** and **bounds** are root elements and other tags are child. 
 
 # In[4]:
 
+class TagCounter(Visitor):
+    def __init__(self):
+        self.tags_count = defaultdict(int)
+    def visit(self, elem):
+        self.tags_count[elem.tag] += 1
+    def empty(self):
+        return TagCounter()
+    def cache_key(self):
+        return ("TagCounter", code_id(self.visit))
+    def merge(self, other):
+        add_counts(self.tags_count, other.tags_count)
+    def result(self):
+        return dict(self.tags_count)
+
 def tag_count():
-    pittsburgh = open(osm_file,"r")
-    tags = {}
-    for _,elem in ET.iterparse(pittsburgh):  
-        if tags.get(elem.tag)== None: tags.update({elem.tag:1})
-        else: tags[elem.tag] += 1
-    return tags
+    return cached_pass([TagCounter()])[0]
 tag_count()
 
 
@@ -60,20 +739,27 @@ tag_count()
 
 # In[5]:
 
-def att():
-    pittsburgh = open(osm_file,"r")
-    k_way = {}
-    k_node = {}
-    for _,elem in ET.iterparse(pittsburgh, events = ("start",)):
-        if elem.tag == "way":  
-            for tag in elem.iter("tag"):
-                if k_way.get(tag.attrib['k'])==None: k_way.update({tag.attrib['k']:1})
-                else: k_way[tag.attrib['k']] +=1
-        if elem.tag =="node": 
-            for tag in elem.iter("tag"):
-                if k_node.get(tag.attrib['k'])==None: k_node.update({tag.attrib['k']:1})
-                else: k_node[tag.attrib['k']] +=1                    
-    return (k_way, k_node)   
+class KeyCounter(Visitor):
+    tags = ("way", "node")
+    def __init__(self):
+        self.k_way = defaultdict(int)
+        self.k_node = defaultdict(int)
+    def visit(self, elem):
+        keys = self.k_way if elem.tag == "way" else self.k_node
+        for tag in elem.iter("tag"):
+            keys[tag.attrib['k']] += 1
+    def empty(self):
+        return KeyCounter()
+    def cache_key(self):
+        return ("KeyCounter", code_id(self.visit))
+    def merge(self, other):
+        add_counts(self.k_way, other.k_way)
+        add_counts(self.k_node, other.k_node)
+    def result(self):
+        return (dict(self.k_way), dict(self.k_node))
+
+def att(approximate=False):
+    return cached_pass([KeySketch() if approximate else KeyCounter()])[0]
 
 
 #  As we can see there are a plenty of attrbutes available in this file. Cleaining all of them take a lot of time. Therefore, we will look into one of the frequent ones i.e. **"addr:street"**, **"building"**,and **"addr:postcode"**. This attrbute is supposed to be the street names and given its importance it should be consistent in the entire dataset. we will now define a function to audit the street names. To simplify the process, I will define multiple functions to use while looping through the XML. This function tell whether an element in the XML is the kind of attribute that we are interested in or not. 
@@ -107,14 +793,23 @@ def user (elem):
 # In[7]:
 
 #this function returns the extent of contribution of each user as well as the number of users overall. 
-def unique_users():
-    pittsburgh = open(osm_file,"r")
-    dct = {}
-    for _,elem in ET.iterparse(pittsburgh, events = ("start",)):
-            if elem.tag == "way" or elem.tag == "node" or elem.tag =="relation": 
-                if dct.get(user(elem)) == None: dct.update({user(elem):1})
-                else: dct[user(elem)]+=1
-    return (len(dct.keys()),dct)
+class UserCounter(Visitor):
+    tags = ("way", "node", "relation")
+    def __init__(self):
+        self.dct = defaultdict(int)
+    def visit(self, elem):
+        self.dct[user(elem)] += 1
+    def empty(self):
+        return UserCounter()
+    def cache_key(self):
+        return ("UserCounter", code_id(self.visit), code_id(user))
+    def merge(self, other):
+        add_counts(self.dct, other.dct)
+    def result(self):
+        return (len(self.dct), dict(self.dct))
+
+def unique_users(approximate=False):
+    return cached_pass([UserSketch() if approximate else UserCounter()])[0]
 # 1313 users have contributed
 
 
@@ -123,22 +818,35 @@ def unique_users():
 # In[8]:
 
 #insert one of the following as function: "is_building","is_city","is_state","is_street_name",is_zipcode","is_county"
-def unique_features(function):
-    pittsburgh = open(osm_file,"r")
-    dct = {}
-    for _,elem in ET.iterparse(pittsburgh, events = ("start",)):
-            if elem.tag == "way" or elem.tag == "node":  
-                for tag in elem.iter("tag"):
-                    if function(tag):
-                        if dct.get(tag.attrib['v'])==None: dct.update({tag.attrib['v']:1})
-                        else: dct[tag.attrib['v']]+=1
-    return dct
+class FeatureCounter(Visitor):
+    tags = ("way", "node")
+    def __init__(self, function):
+        self.function = function
+        self.dct = defaultdict(int)
+    def visit(self, elem):
+        for tag in elem.iter("tag"):
+            if self.function(tag):
+                self.dct[tag.attrib['v']] += 1
+    def empty(self):
+        return FeatureCounter(self.function)
+    def cache_key(self):
+        # only plain functions whose code and data can be identified are cached
+        function = predicate_id(self.function)
+        if function is None: return None
+        return ("FeatureCounter", code_id(self.visit), function)
+    def merge(self, other):
+        add_counts(self.dct, other.dct)
+    def result(self):
+        return dict(self.dct)
+
+def unique_features(function, approximate=False):
+    return cached_pass([FeatureSketch(function) if approximate else FeatureCounter(function)])[0]
 
 
 # In[10]:
 
-unique_features(is_building)
-unique_features(is_state)
+# both questions are answered from the same scan of the file
+buildings_count, states_count = cached_pass([FeatureCounter(is_building), FeatureCounter(is_state)])
 
 
 # We can see that some errors have occured by the users while entering data into OSM. The common abbreviation for "Pennsylvania"   is "PA" while we can see some other forms here(e.g. p,pa etc.). Some other abbreviations belong to other states which cannot possibly be correct. NOw let's take a look at the buildings: 
@@ -167,21 +875,42 @@ def audit_zipcode(invalid_zipcodes,zipcode):
     except ValueError:
         invalid_zipcodes[zipcode] += 1
 
+# the rules above, wrapped so that the visitors can treat them like any other profile
+class ModuleRules(object):
+    def audit_street_type(self, street_types, street_name):
+        audit_street_type(street_types, street_name)
+    def audit_zipcode(self, invalid_zipcodes, zipcode):
+        audit_zipcode(invalid_zipcodes, zipcode)
+pittsburgh_rules = ModuleRules()
+
 
 # We will now define the **"audit()"** function to simultanioulsly check for errors in both zip codes and street names. 
 
 # In[27]:
 
-def audit():
-    pittsburgh = open(osm_file,"r")
-    for _,elem in ET.iterparse(pittsburgh, events = ("start",)):
-        if elem.tag == "way" or elem.tag == "node":  
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-                elif is_zipcode(tag):
-                    audit_zipcode(invalid_zipcodes, tag.attrib['v'])
-    return (invalid_zipcodes, street_types) 
+class Auditor(Visitor):
+    tags = ("way", "node")
+    def __init__(self, street_types, invalid_zipcodes, profile=None):
+        self.street_types = street_types
+        self.invalid_zipcodes = invalid_zipcodes
+        self.profile = profile
+    def visit(self, elem):
+        rules = self.profile or pittsburgh_rules
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                rules.audit_street_type(self.street_types, tag.attrib['v'])
+            elif is_zipcode(tag):
+                rules.audit_zipcode(self.invalid_zipcodes, tag.attrib['v'])
+    def empty(self):
+        return Auditor(defaultdict(set), defaultdict(int), self.profile)
+    def merge(self, other):
+        for street_type, names in other.street_types.iteritems(): self.street_types[street_type] |= names
+        add_counts(self.invalid_zipcodes, other.invalid_zipcodes)
+    def result(self):
+        return (self.invalid_zipcodes, self.street_types)
+
+def audit(approximate=False):
+    return run_pass([AuditSketch() if approximate else Auditor(street_types, invalid_zipcodes)])[0]
 
 
 # In[28]:
@@ -189,6 +918,275 @@ def audit():
 audit()
 
 
+# The counters above keep one dictionary entry for every distinct key, value, user and street name. That is fine for Pittsburgh, but on a whole country or the planet these dictionaries take gigabytes. With **approximate=True**, **att()**, **unique_users()**, **unique_features()** and **audit()** run in a fixed amount of memory instead. Every column of keys goes into a **FrequencySketch**: a **count-min sketch** gives the frequency of any key, overestimated by at most **epsilon** times the number of keys counted, with probability 1 - **delta**. The sketch also remembers the **top** most frequent keys, and a **HyperLogLog** estimates the number of distinct keys with a relative standard error of **error**. The keys are hashed and added in numpy batches. The results have the same shape as in the exact mode, but each dictionary holds only the most frequent keys and is a **TopCounts** that also carries **distinct**, **total** and **error_bound**. **audit()** keeps a **Reservoir** sample of at most **samples** street names for each of the first **groups** unexpected street types, instead of every name. The bounds are set in **sketch_settings**; the defaults use about 1 MB per sketch. The sketches merge, so the approximate visitors also run with **run_sharded()**. The exact mode is still the default, and it is the right choice for a city sized file. 
+
+# In[ ]:
+
+sketch_settings = {'epsilon': 0.0001, 'delta': 0.01, 'error': 0.01, 'top': 100}
+
+def hash64(keys):
+    # 64 bit hashes of the keys: hash() mixed by the splitmix64 finalizer, so every bit can be used
+    h = np.array([hash(key) for key in keys], dtype=np.int64).view(np.uint64)
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94d049bb133111eb)
+    h ^= h >> np.uint64(31)
+    return h
+
+def bit_length(x):
+    x = x.copy()
+    n = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = (x >> np.uint64(shift)) != 0
+        n[big] += shift
+        x[big] >>= np.uint64(shift)
+    return n + (x != 0)
+
+class CountMinSketch(object):
+    def __init__(self, epsilon=0.0001, delta=0.01):
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+    # the row i column of a key is h1 + i * h2, from the two halves of its hash
+    def columns(self, hashes, row):
+        return ((hashes & np.uint64(0xffffffff)) + np.uint64(row) * (hashes >> np.uint64(32))) % np.uint64(self.width)
+    def add(self, hashes):
+        for row in range(self.depth):
+            self.table[row] += np.bincount(self.columns(hashes, row).astype(np.int64), minlength=self.width)
+    def estimate(self, hashes):
+        return np.min([self.table[row][self.columns(hashes, row).astype(np.int64)] for row in range(self.depth)], axis=0)
+    def merge(self, other):
+        self.table += other.table
+
+class HyperLogLog(object):
+    def __init__(self, error=0.01):
+        # the standard error is 1.04 / sqrt(number of registers)
+        self.p = min(max(int(math.ceil(math.log((1.04 / error) ** 2, 2))), 4), 18)
+        self.registers = np.zeros(1 << self.p, dtype=np.uint8)
+    def add(self, hashes):
+        bits = 64 - self.p
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        # position of the first 1 bit in the rest of the hash
+        rank = bits + 1 - bit_length(hashes & np.uint64((1 << bits) - 1))
+        order = np.lexsort((rank, index))
+        index, rank = index[order], rank[order]
+        last = np.r_[index[1:] != index[:-1], True]
+        index, rank = index[last], rank[last]
+        self.registers[index] = np.maximum(self.registers[index], rank)
+    def count(self):
+        m = float(len(self.registers))
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = np.count_nonzero(self.registers == 0)
+        # linear counting is more accurate while many registers are still empty
+        if estimate <= 2.5 * m and zeros: estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+class TopCounts(dict):
+    # the most frequent keys with their estimated counts, and what is known about the others
+    def __init__(self, counts, distinct, total, error_bound):
+        dict.__init__(self, counts)
+        self.distinct = distinct
+        self.total = total
+        self.error_bound = error_bound
+
+class FrequencySketch(object):
+    def __init__(self, epsilon=0.0001, delta=0.01, error=0.01, top=100, batch=10000):
+        self.epsilon = epsilon
+        self.counts = CountMinSketch(epsilon, delta)
+        self.distinct = HyperLogLog(error)
+        self.top_size = top
+        self.top = {}
+        self.batch = batch
+        self.pending = []
+        self.total = 0
+    def add(self, key):
+        self.pending.append(key)
+        if len(self.pending) >= self.batch: self.flush()
+    def flush(self):
+        if not self.pending: return
+        keys, self.pending = self.pending, []
+        hashes = hash64(keys)
+        self.counts.add(hashes)
+        self.distinct.add(hashes)
+        self.total += len(keys)
+        self.top.update(zip(keys, hashes))
+        self.trim()
+    # keeps the top keys whose estimated count is the highest
+    def trim(self):
+        if len(self.top) <= self.top_size: return
+        keys = self.top.keys()
+        hashes = np.array([self.top[key] for key in keys], dtype=np.uint64)
+        keep = np.argsort(-self.counts.estimate(hashes), kind='mergesort')[:self.top_size]
+        self.top = dict((keys[i], hashes[i]) for i in keep)
+    def most_common(self, n=None):
+        self.flush()
+        keys = self.top.keys()
+        if not keys: return []
+        estimates = self.counts.estimate(np.array([self.top[key] for key in keys], dtype=np.uint64))
+        return sorted(zip(keys, estimates.tolist()), key=lambda item: -item[1])[:n]
+    def result(self):
+        self.flush()
+        return TopCounts(self.most_common(), self.distinct.count(), self.total, int(math.ceil(self.epsilon * self.total)))
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.counts.merge(other.counts)
+        self.distinct.merge(other.distinct)
+        self.total += other.total
+        self.top.update(other.top)
+        self.trim()
+
+class Reservoir(object):
+    # uniform sample of at most size of the values added so far
+    def __init__(self, size=10, seed=None):
+        self.size = size
+        self.seen = 0
+        self.sample = []
+        self.random = random.Random(seed)
+    def add(self, value):
+        self.seen += 1
+        if len(self.sample) < self.size: self.sample.append(value)
+        else:
+            i = self.random.randrange(self.seen)
+            if i < self.size: self.sample[i] = value
+    def merge(self, other):
+        # every place of the merged sample comes from one of the two in proportion to how many values they saw
+        mine, theirs = list(self.sample), list(other.sample)
+        self.random.shuffle(mine)
+        self.random.shuffle(theirs)
+        sample = []
+        while len(sample) < self.size and (mine or theirs):
+            take_mine = mine and (not theirs or self.random.random() * (self.seen + other.seen) < self.seen)
+            sample.append(mine.pop() if take_mine else theirs.pop())
+        self.sample = sample
+        self.seen += other.seen
+
+class SketchVisitor(Visitor):
+    def __init__(self, settings=None):
+        self.settings = dict(sketch_settings, **(settings or {}))
+    def sketch(self):
+        return FrequencySketch(**self.settings)
+    def merge(self, other):
+        for name, sketch in self.sketches().iteritems(): sketch.merge(other.sketches()[name])
+    def cache_key(self):
+        return (type(self).__name__, code_id(self.visit), sorted(self.settings.items()))
+
+class KeySketch(SketchVisitor):
+    tags = ("way", "node")
+    def __init__(self, settings=None):
+        SketchVisitor.__init__(self, settings)
+        self.k_way = self.sketch()
+        self.k_node = self.sketch()
+    def sketches(self):
+        return {'k_way': self.k_way, 'k_node': self.k_node}
+    def visit(self, elem):
+        keys = self.k_way if elem.tag == "way" else self.k_node
+        for tag in elem.iter("tag"): keys.add(tag.attrib['k'])
+    def empty(self):
+        return KeySketch(self.settings)
+    def result(self):
+        return (self.k_way.result(), self.k_node.result())
+
+class UserSketch(SketchVisitor):
+    tags = ("way", "node", "relation")
+    def __init__(self, settings=None):
+        SketchVisitor.__init__(self, settings)
+        self.users = self.sketch()
+    def sketches(self):
+        return {'users': self.users}
+    def visit(self, elem):
+        self.users.add(user(elem))
+    def empty(self):
+        return UserSketch(self.settings)
+    def cache_key(self):
+        return SketchVisitor.cache_key(self) + (code_id(user),)
+    def result(self):
+        counts = self.users.result()
+        return (counts.distinct, counts)
+
+class FeatureSketch(SketchVisitor):
+    tags = ("way", "node")
+    def __init__(self, function, settings=None):
+        SketchVisitor.__init__(self, settings)
+        self.function = function
+        self.values = self.sketch()
+    def sketches(self):
+        return {'values': self.values}
+    def visit(self, elem):
+        for tag in elem.iter("tag"):
+            if self.function(tag): self.values.add(tag.attrib['v'])
+    def empty(self):
+        return FeatureSketch(self.function, self.settings)
+    def cache_key(self):
+        function = predicate_id(self.function)
+        if function is None: return None
+        return SketchVisitor.cache_key(self) + (function,)
+    def result(self):
+        return self.values.result()
+
+class SketchCounts(object):
+    # stands in for the invalid_zipcodes defaultdict(int) of the audit rules: counts[key] += 1 adds key to the sketch
+    def __init__(self, sketch):
+        self.sketch = sketch
+    def __getitem__(self, key):
+        return 0
+    def __setitem__(self, key, value):
+        self.sketch.add(key)
+
+class SketchSamples(object):
+    # stands in for the street_types defaultdict(set): counts the street types and samples their names
+    def __init__(self, sketch, samples=10, groups=1000):
+        self.sketch = sketch
+        self.samples = {}
+        self.sample_size = samples
+        self.groups = groups
+    def __getitem__(self, street_type):
+        self.sketch.add(street_type)
+        reservoir = self.samples.get(street_type)
+        if reservoir is None:
+            # past the first groups street types only the counts are kept
+            if len(self.samples) >= self.groups: return Reservoir(0)
+            reservoir = self.samples[street_type] = Reservoir(self.sample_size, street_type)
+        return reservoir
+    def merge(self, other):
+        for street_type, reservoir in other.samples.iteritems():
+            if street_type in self.samples: self.samples[street_type].merge(reservoir)
+            elif len(self.samples) < self.groups: self.samples[street_type] = reservoir
+
+class AuditSketch(SketchVisitor):
+    tags = ("way", "node")
+    def __init__(self, profile=None, settings=None, samples=10, groups=1000):
+        SketchVisitor.__init__(self, settings)
+        self.profile = profile
+        self.samples = samples
+        self.groups = groups
+        self.invalid_zipcodes = SketchCounts(self.sketch())
+        self.street_types = SketchSamples(self.sketch(), samples, groups)
+    def sketches(self):
+        return {'invalid_zipcodes': self.invalid_zipcodes.sketch, 'street_types': self.street_types.sketch}
+    # the same rules as the Auditor, writing into the sketches instead of the dictionaries
+    def visit(self, elem):
+        rules = self.profile or pittsburgh_rules
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                rules.audit_street_type(self.street_types, tag.attrib['v'])
+            elif is_zipcode(tag):
+                rules.audit_zipcode(self.invalid_zipcodes, tag.attrib['v'])
+    def empty(self):
+        return AuditSketch(self.profile, self.settings, self.samples, self.groups)
+    def cache_key(self):
+        return None
+    def merge(self, other):
+        SketchVisitor.merge(self, other)
+        self.street_types.merge(other.street_types)
+    def result(self):
+        samples = dict((street_type, set(reservoir.sample)) for street_type, reservoir in self.street_types.samples.iteritems())
+        return (self.invalid_zipcodes.sketch.result(), samples)
+
+
 # As you can see there are a large number of attributes and the data entered are not as accurate. The process of editing could be extended to all those attributes. For the purposes of this project we will try to edit zip codes, streets and state. Auditing the zip codes showed that some of the zipcodes are in 9-digits format while most of our zip codes are in 5-digits. Some zip codes also include "PA" at the beginning which is redundant. The street names also show a number of inconsistencies however, we can remedy most of these by creating a dictionary that converts the undesired abbreviations to a standard form. 
 
 # In[183]:
@@ -244,6 +1242,86 @@ def update_landuse(building):
     if not mapping_bld.get(building)==None:building = mapping_bld[building]
     else : building = "other"
     return building 
+# a dictionary lookup, TagCleaner calls it directly instead of memoizing it
+update_landuse.memoize = False
+
+
+# The lists and dictionaries above (and the 15001-16263 zip code range) only make sense for Pittsburgh. To clean another city we should not have to edit them, so the same rules can also be stored as a **region profile** in a JSON file (see **profiles/pittsburgh.json**). A profile is compiled once when it is loaded: the expected street types become a set, the valid zip codes become a sorted list of merged ranges that is searched with **bisect**, and the mapping dictionaries are used as they are. Loaded profiles are kept in **profiles** by name, so one process can clean several cities side by side by passing a profile to the visitors, e.g. **TagsTable("way", TagCleaner(profile=profiles["pittsburgh"]))** or **Auditor(defaultdict(set), defaultdict(int), profiles["pittsburgh"])**. 
+
+# In[ ]:
+
+class ZipRanges(object):
+    # set of valid zip codes stored as sorted, non overlapping (low, high) ranges
+    def __init__(self, ranges):
+        lows, highs = [], []
+        for low, high in sorted((int(low), int(high)) for low, high in ranges):
+            if highs and low <= highs[-1] + 1: highs[-1] = max(highs[-1], high)
+            else:
+                lows.append(low)
+                highs.append(high)
+        self.lows = lows
+        self.highs = highs
+    def __contains__(self, zipcode):
+        i = bisect.bisect_right(self.lows, zipcode) - 1
+        return i >= 0 and zipcode <= self.highs[i]
+    # same test for a whole array of zip codes at once
+    def contains(self, zipcodes):
+        zipcodes = np.asarray(zipcodes)
+        if not self.lows: return np.zeros(zipcodes.shape, dtype=bool)
+        i = np.searchsorted(self.lows, zipcodes, side='right') - 1
+        return (i >= 0) & (zipcodes <= np.asarray(self.highs)[np.maximum(i, 0)])
+    def ranges(self):
+        return [[low, high] for low, high in zip(self.lows, self.highs)]
+
+class RegionProfile(object):
+    def __init__(self, name, expected, mapping_str, mapping_bld, zipcodes, default_landuse="other"):
+        self.name = name
+        self.expected = frozenset(expected)
+        self.mapping_str = dict(mapping_str)
+        self.mapping_bld = dict(mapping_bld)
+        self.zipcodes = ZipRanges(zipcodes)
+        self.default_landuse = default_landuse
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls(**json.load(f))
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({'name': self.name, 'expected': sorted(self.expected), 'mapping_str': self.mapping_str,
+                       'mapping_bld': self.mapping_bld, 'zipcodes': self.zipcodes.ranges(),
+                       'default_landuse': self.default_landuse}, f, indent=1, sort_keys=True)
+    def audit_street_type(self, street_types, street_name):
+        m = street_type_re.search(street_name)
+        if m:
+            street_type = m.group()
+            if street_type not in self.expected:
+                street_types[street_type].add(street_name)
+    def audit_zipcode(self, invalid_zipcodes, zipcode):
+        try:
+            if int(zipcode) not in self.zipcodes:
+                raise ValueError
+        except ValueError:
+            invalid_zipcodes[zipcode] += 1
+    def update_street_name(self, name):
+        return update_street_name(name, self.mapping_str)
+    def update_zipcode(self, zipcode):
+        lst = re.findall(r'\d+', zipcode)
+        if lst == [] or int(lst[0]) not in self.zipcodes: return "0"
+        return int(lst[0])
+    def update_landuse(self, building):
+        return self.mapping_bld.get(building, self.default_landuse)
+    update_landuse.memoize = False
+    def cleaners(self):
+        return {"addr:postcode": self.update_zipcode, "addr:street": self.update_street_name,
+                "building": self.update_landuse}
+
+profiles = {}
+def load_profile(filename):
+    profile = RegionProfile.load(filename)
+    profiles[profile.name] = profile
+    return profile
+
+load_profile("profiles/pittsburgh.json")
 
 
 # # Modify and save the attributes into a CSV file
@@ -254,20 +1332,174 @@ def update_landuse(building):
 
 # create nodes table
 node_cols = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
+class ElementTable(Visitor):
+    # emits one row per element with the given attribute columns
+    def __init__(self, tag, cols):
+        self.tags = (tag,)
+        self.cols = cols
+        self.table = defaultdict(list)
+    def visit(self, elem):
+        for col in self.cols:
+            try:
+                self.table[col].append(elem.attrib[col].encode('utf-8'))
+            except:
+                self.table[col].append(float('nan'))
+    def empty(self):
+        return ElementTable(self.tags[0], self.cols)
+    def merge(self, other):
+        for col, values in other.table.iteritems(): self.table[col].extend(values)
+    def result(self):
+        return pd.DataFrame(self.table).fillna(method='ffill')
+
 def nodes_table ():
-    pittsburgh = open(osm_file,"r")
-    nodes = defaultdict(list)
-    for _,elem in ET.iterparse(pittsburgh, events = ("start",)):
-        if elem.tag == "node":
-            for col in node_cols:
-                try:    
-                    nodes[col].append(elem.attrib[col].encode('utf-8'))
-                except:
-                    nodes[col].append(float('nan'))
-    return pd.DataFrame(nodes).fillna(method='ffill')
-nodes_table().to_csv('nodes.csv', index=True, header=False)
-nodes = nodes_table()
-nodes.head(10)
+    return run_pass([ElementTable("node", node_cols)])[0]
+
+
+# Keeping every attribute of every node as a Python string is what makes this table so big in memory. **NodeStore** keeps the nodes in typed numpy columns instead, filled directly while parsing: 64 bit integers for the ids, uid and changeset, 64 bit floats for the coordinates (or, with **fixed_point=True**, 32 bit integers in units of 1e-7 degrees, which is the precision OSM uses, with **missing_e7**, the smallest 32 bit integer, for a missing coordinate since every other value is a valid one), and dictionary encoded columns for the user names and the timestamps, where each distinct string is stored only once and the rows hold a small integer code. **column()** returns a view of a column without copying it and **to_dataframe()** hands all of them to pandas, with the dictionary encoded columns as categoricals and the fixed point coordinates as nullable integers, so a missing one is NA and mean() or min() skip it. **column_frame()** builds that DataFrame with one block per column, because pandas otherwise copies the columns of the same type into one block, so the frame shares its memory with the store until pandas merges the blocks for an operation that needs it (the codes of a categorical with few distinct values are copied anyway, as pandas narrows them to 8 or 16 bit integers). Building the blocks relies on pandas internals, so on the versions it was not checked with (**shared_frames**) the frame is made by the usual constructor, which copies. For example **node_store = run_pass([NodeStore(fixed_point=True)])[0]**. 
+
+# In[ ]:
+
+# fixed point coordinates are at most 1.8e9, so the smallest int32 can't be a real one
+missing_e7 = np.iinfo(np.int32).min
+
+# the block layout of a DataFrame is internal to pandas, so the columns are only shared on the versions it was checked with
+shared_frames = BlockManager is not None and LooseVersion("0.20") <= LooseVersion(pd.__version__) < LooseVersion("2.0")
+IntegerArray = getattr(getattr(pd, "arrays", None), "IntegerArray", None)
+
+def masked(values, missing):
+    # the sentinel becomes NA, so mean(), min() and the like skip it (the nullable integers keep sharing the values)
+    if missing is None: return values
+    if IntegerArray is not None: return IntegerArray(values, values == missing)
+    return np.where(values == missing, np.nan, values)
+
+def column_frame(data):
+    # pd.DataFrame(data) copies the columns of one dtype into a single 2d block, here every column gets a block of its own.
+    # pandas still merges them (and copies) the first time an operation needs it
+    if shared_frames:
+        try:
+            blocks = [make_block(values.reshape(1, -1) if isinstance(values, np.ndarray) else values, placement=[i])
+                      for i, values in enumerate(data.itervalues())]
+            rows = len(next(data.itervalues())) if data else 0
+            return pd.DataFrame(BlockManager(blocks, [pd.Index(list(data)), pd.RangeIndex(rows)]))
+        except (TypeError, ValueError, AssertionError): pass
+    return pd.DataFrame(data, columns=list(data), copy=False)
+
+class Column(object):
+    # numpy array that grows as values are appended, values() is a view of the filled part
+    # missing is the value stored for a missing one, scale the factor from the stored integers to the real values
+    def __init__(self, dtype, capacity=1024, missing=None, scale=None):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+        self.missing = missing
+        self.scale = scale
+    def reserve(self, size):
+        if size > len(self.data):
+            data = np.empty(max(size, 2 * len(self.data)), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+    def append(self, value):
+        if self.size == len(self.data): self.reserve(self.size + 1)
+        self.data[self.size] = value
+        self.size += 1
+    def extend(self, values):
+        self.reserve(self.size + len(values))
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+    def values(self):
+        return self.data[:self.size]
+    def nbytes(self):
+        return self.data.nbytes
+
+class DictColumn(object):
+    # strings stored once each, the rows hold int32 codes into categories (-1 for missing)
+    def __init__(self):
+        self.codes = Column(np.int32)
+        self.index = {}
+        self.categories = []
+    def code(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.categories)
+            self.categories.append(value)
+        return code
+    def append(self, value):
+        self.codes.append(-1 if value is None else self.code(value))
+    def extend(self, other):
+        remap = np.array([self.code(value) for value in other.categories] + [-1], dtype=np.int32)
+        # code -1 picks the last entry of remap, which keeps missing values missing
+        self.codes.extend(remap[other.codes.values()])
+    def values(self):
+        return pd.Categorical.from_codes(self.codes.values(), self.categories)
+    def nbytes(self):
+        return self.codes.nbytes() + sum(len(value) for value in self.categories)
+
+class ColumnStore(Visitor):
+    # a table kept as named Column/DictColumn objects in self.columns
+    def merge(self, other):
+        for col, column in self.columns.iteritems():
+            if isinstance(column, DictColumn): column.extend(other.columns[col])
+            else: column.extend(other.columns[col].values())
+    def result(self):
+        return self
+    def __len__(self):
+        return self.columns['id'].size
+    def column(self, col):
+        return self.columns[col].values()
+    def names(self):
+        return list(self.columns)
+    # the name of a column in DataFrames and exported tables
+    def label(self, col):
+        return col
+    def to_dataframe(self):
+        data = OrderedDict()
+        for col in self.names():
+            column = self.columns[col]
+            values = column.values() if isinstance(column, DictColumn) else masked(column.values(), column.missing)
+            data[self.label(col)] = values
+        return column_frame(data)
+    def nbytes(self):
+        return sum(column.nbytes() for column in self.columns.itervalues())
+
+class ElementStore(ColumnStore):
+    # typed columns for the attributes of one kind of element (ways, or nodes with NodeStore)
+    int_cols = [('id', np.int64), ('uid', np.int64), ('version', np.int32), ('changeset', np.int64)]
+    dict_cols = ['user', 'timestamp']
+    def __init__(self, tag="way"):
+        self.tags = (tag,)
+        self.cols = way_cols
+        self.columns = OrderedDict()
+        for col, dtype in self.int_cols: self.columns[col] = Column(dtype)
+        for col in self.dict_cols: self.columns[col] = DictColumn()
+    def visit(self, elem):
+        a = elem.attrib
+        columns = self.columns
+        # missing numbers are stored as -1
+        for col, _ in self.int_cols: columns[col].append(int(a.get(col, -1)))
+        for col in self.dict_cols: columns[col].append(a.get(col))
+    def empty(self):
+        return ElementStore(self.tags[0])
+    def names(self):
+        return [col for col in self.cols if col in self.columns]
+
+class NodeStore(ElementStore):
+    def __init__(self, fixed_point=False):
+        ElementStore.__init__(self, "node")
+        self.cols = node_cols
+        self.fixed_point = fixed_point
+        for col in ('lat', 'lon'):
+            self.columns[col] = Column(np.int32, missing=missing_e7, scale=1e-7) if fixed_point else Column(np.float64)
+    def visit(self, elem):
+        ElementStore.visit(self, elem)
+        a = elem.attrib
+        # missing coordinates are stored as missing_e7 (or NaN for float coordinates)
+        for col in ('lat', 'lon'):
+            if self.fixed_point: self.columns[col].append(int(round(float(a[col]) * 1e7)) if col in a else missing_e7)
+            else: self.columns[col].append(float(a.get(col, 'nan')))
+    def empty(self):
+        return NodeStore(self.fixed_point)
+    def label(self, col):
+        # the fixed point coordinates are not degrees, the name says so
+        return col + "_e7" if self.fixed_point and col in ('lat', 'lon') else col
 
 
 # In[277]:
@@ -275,22 +1507,10 @@ nodes.head(10)
 #creat ways table
 way_cols = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 def ways_table():
-    pittsburgh = open(osm_file,"r")
-    ways= defaultdict(list)
-    for _, elem in ET.iterparse(pittsburgh, events=("start",)):
-        if elem.tag == "way":
-            for col in way_cols:
-                try:
-                    ways[col].append(elem.attrib[col].encode('utf-8'))
-                except:
-                    ways[col].append(float('nan'))
-    return pd.DataFrame(ways).fillna(method='ffill')
-ways_table().to_csv('ways.csv', index=True, header=False)
-ways = ways_table()
-ways.head(10)
+    return run_pass([ElementTable("way", way_cols)])[0]
 
 
-# The nodes_tags and ways_tags are a bit more complicated. Here, we want to edit the data by means of the functions that we defined earlier (e.g. update_landuse, update_street_name etc.). Additionally, as we saw earlier, some attributed have a colon character in them (e.g. addr:street). We want to know th type of these attributes (e.g. addr, tiger etc.) therefore, we will check if a colon character exists first, if the colon exists we split on ":" and save the left side of teh split in another column. if no colon exists then "NA" will be applied to that column. 
+# The nodes_tags and ways_tags are a bit more complicated. Here, we want to edit the data by means of the functions that we defined earlier (e.g. update_landuse, update_street_name etc.). Additionally, as we saw earlier, some attributed have a colon character in them (e.g. addr:street). We want to know th type of these attributes (e.g. addr, tiger etc.) therefore, we will check if a colon character exists first, if the colon exists we split on ":" and save the left side of teh split in another column. if no colon exists then "NA" will be applied to that column. The same few keys show up millions of times, so the key checks and the choice of the cleaning function are done once per distinct key by a small **TagCleaner**, which also remembers the cleaned values of the zip code and street name cleaners in a plain dictionary that is emptied whenever it holds **cache_size** values (the building types are a single dictionary lookup, which is faster than the memo, so **update_landuse** is marked with **memoize = False** and called directly). 
 
 # In[273]:
 
@@ -298,63 +1518,251 @@ ways.head(10)
 lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
 problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 #nodes_tags_cols = ['id','attribute', 'value', 'attribute_type']
+# returns (attribute, attribute_type), attribute_type is None if there is no colon in the key
+def split_key(key):
+    # if colon exists in the 'k' attribute
+    if lower_colon.search(key):
+        attribute_type, attribute = key.split(":",1)
+        return (attribute, attribute_type)
+    # if colon does not exist in 'k' attribute
+    return (key, None)
+
+def clean_street_name(name):
+    return update_street_name(name, mapping_str)
+
+# modify some values (i.e. street names, buildings, and zipcodes), the cleaner is picked by the tag key
+tag_cleaners = {"addr:postcode": update_zipcode, "addr:street": clean_street_name, "building": update_landuse}
+
+class LRUCache(object):
+    # dictionary that forgets the least recently used entries once it holds more than maxsize of them
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize: self.data.popitem(last=False)
+    def clear(self):
+        self.data.clear()
+
+class TagCleaner(object):
+    # OSM reuses a small set of keys millions of times, so the problem chars check, the colon split
+    # and the cleaner lookup are done once per distinct key, and the values of the expensive cleaners are memoized
+    def __init__(self, cleaners=None, cache_size=100000, profile=None):
+        if cleaners is None: cleaners = profile.cleaners() if profile is not None else tag_cleaners
+        self.cleaners = cleaners
+        self.profile = profile
+        self.keys = {}
+        self.cache_size = cache_size
+        self.values = {}
+    # only the settings are sent to other processes, the caches and the bound methods of a profile are rebuilt
+    def __getstate__(self):
+        return {'cleaners': None if self.profile is not None else self.cleaners,
+                'cache_size': self.cache_size, 'profile': self.profile}
+    def __setstate__(self, state):
+        self.__init__(**state)
+    def classify(self, key):
+        if problemchars.search(key): info = None
+        else:
+            attribute, attribute_type = split_key(key)
+            cleaner = self.cleaners.get(key)
+            # cleaners marked with memoize = False are cheaper than the memo itself
+            info = (attribute, attribute_type, cleaner, getattr(cleaner, 'memoize', True))
+        self.keys[key] = info
+        return info
+    # returns (attribute, attribute_type, value) or None if the key has problem characters
+    def clean(self, key, value):
+        try:
+            info = self.keys[key]
+        except KeyError:
+            info = self.classify(key)
+        if info is None: return None
+        attribute, attribute_type, cleaner, memoize = info
+        if cleaner is None: return (attribute, attribute_type, value.encode('utf-8'))
+        if not memoize: return (attribute, attribute_type, cleaner(value))
+        values = self.values
+        new_value = values.get((key, value), self)
+        if new_value is self:
+            new_value = cleaner(value)
+            # a plain dict that starts over once it is full, keeping it in LRU order costs more than most cleaners
+            if len(values) >= self.cache_size: values.clear()
+            values[key, value] = new_value
+        return (attribute, attribute_type, new_value)
+    # call this after changing the mapping dictionaries
+    def clear(self):
+        self.keys.clear()
+        self.values.clear()
+
+tag_cleaner = TagCleaner()
+
+class TimedTagCleaner(TagCleaner):
+    # made by Metrics.instrument(), adds the time spent in clean() to the "clean" stage
+    def __init__(self, metrics, cleaners, cache_size=100000):
+        TagCleaner.__init__(self, cleaners, cache_size)
+        self.metrics = metrics
+    def clean(self, key, value):
+        start = time.time()
+        row = TagCleaner.clean(self, key, value)
+        self.metrics.add_time("clean", time.time() - start)
+        return row
+
+class TagsTable(Visitor):
+    # emits one row per <tag> child of the given element, cleaning the values on the way
+    def __init__(self, tag, cleaner=None):
+        self.tags = (tag,)
+        self.cleaner = cleaner
+        self.table = defaultdict(list)
+    def visit(self, elem):
+        table = self.table
+        clean = (self.cleaner or tag_cleaner).clean
+        for tag in elem.iter("tag"):
+            row = clean(tag.attrib['k'], tag.attrib['v'])
+            if row is not None:
+                attribute, attribute_type, value = row
+                table['id'].append(elem.attrib['id'])
+                table['attribute'].append(attribute)
+                if attribute_type is not None: table['attribute_type'].append(attribute_type)
+                else: table['type'].append('NA')
+                table['value'].append(value)
+    def empty(self):
+        return TagsTable(self.tags[0], self.cleaner)
+    def merge(self, other):
+        for col, values in other.table.iteritems(): self.table[col].extend(values)
+    def result(self):
+        return pd.DataFrame(dict([(x,pd.Series(y)) for x,y in self.table.iteritems()]))
+
 def nodes_tags_table ():
-    pittsburgh = open(osm_file,"r")
-    nodes_tags = defaultdict(list)
-    for _,elem in ET.iterparse(pittsburgh, events = ("start",)):
-        if elem.tag == "node":
-            for tag in elem.iter("tag"):
-                if not problemchars.search(tag.attrib['k']):
-                    nodes_tags['id'].append(elem.attrib['id'])
-                    cln = lower_colon.search(tag.attrib['k'])
-                    # if colon exists in the 'k' attribute
-                    if cln: 
-                        nodes_tags['attribute'].append(tag.attrib['k'].split(":",1)[1])
-                        nodes_tags['attribute_type'].append(tag.attrib['k'].split(":",1)[0])
-                    # if colon does not exist in 'k' attribute
-                    else: 
-                        nodes_tags['attribute'].append(tag.attrib['k'])
-                        nodes_tags['type'].append('NA')
-                    # modify some values (i.e. street names, buildings, and zipcodes)
-                    if is_zipcode(tag):nodes_tags['value'].append(update_zipcode(tag.attrib['v']))
-                    elif is_street_name(tag):nodes_tags['value'].append(update_street_name(tag.attrib['v'], mapping_str))
-                    elif is_building(tag): nodes_tags['value'].append(update_landuse(tag.attrib['v']))
-                    else: nodes_tags['value'].append(tag.attrib['v'].encode('utf-8'))
-    return pd.DataFrame(dict([(x,pd.Series(y)) for x,y in nodes_tags.iteritems()]))
-nodes_tags_table().to_csv('nodes_tags.csv', index=True, header=False)
-nodes_tags = nodes_tags_table()
-nodes_tags.head(10)
+    return run_pass([TagsTable("node")])[0]
 
 
 # In[416]:
 
 def ways_tags_table ():
-    pittsburgh = open(osm_file,"rb")
-    ways_tags = defaultdict(list)
-    for _,elem in ET.iterparse(pittsburgh, events = ("start",)):
-        if elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if not problemchars.search(tag.attrib['k']):
-                    ways_tags['id'].append(elem.attrib['id'])
-                    cln = lower_colon.search(tag.attrib['k'])
-                    # if colon exists in the 'k' attribute
-                    if cln: 
-                        ways_tags['attribute'].append(tag.attrib['k'].split(":",1)[1])
-                        ways_tags['attribute_type'].append(tag.attrib['k'].split(":",1)[0])
-                    # if colon does not exist in 'k' attribute
-                    else: 
-                        ways_tags['attribute'].append(tag.attrib['k'])
-                        ways_tags['type'].append('NA')
-                    if is_zipcode(tag):ways_tags['value'].append(update_zipcode(tag.attrib['v']))
-                    elif is_street_name(tag):ways_tags['value'].append(update_street_name(tag.attrib['v'], mapping_str))
-                    elif is_building(tag): ways_tags['value'].append(update_landuse(tag.attrib['v']))
-                    else: ways_tags['value'].append(tag.attrib['v'].encode('utf-8'))
-    return pd.DataFrame(dict([(x,pd.Series(y)) for x,y in ways_tags.iteritems()])) 
-ways_tags_table().to_csv('ways_tags.csv', index=True, header=False)
-ways_tags = ways_tags_table()
+    return run_pass([TagsTable("way")])[0]
+
+
+# All four tables are built from one scan of the XML file and each DataFrame is kept, so we don't have to parse the file again just to look at the first rows. 
+
+# In[ ]:
+
+nodes, ways, nodes_tags, ways_tags = run_pass([ElementTable("node", node_cols), ElementTable("way", way_cols),
+                                               TagsTable("node"), TagsTable("way")])
+nodes.to_csv('nodes.csv', index=True, header=False)
+ways.to_csv('ways.csv', index=True, header=False)
+nodes_tags.to_csv('nodes_tags.csv', index=True, header=False)
+ways_tags.to_csv('ways_tags.csv', index=True, header=False)
+nodes.head(10)
+ways.head(10)
+nodes_tags.head(10)
 ways_tags.head(10)
 
 
+# CSV is the slowest and largest way to store these tables, and every program that reads them has to parse the text again. **export_tables()** writes the same four tables in a binary columnar layout instead: one directory per table with one NumPy **.npy** file per column (the dictionary encoded columns are saved as their integer codes plus a JSON list of the distinct strings) and a **_meta.json** file with the number of rows and the minimum and maximum of every numeric column for each group of **row_group_size** rows, so a reader can skip the groups it does not need. **read_table()** opens the columns as memory mapped arrays and builds the DataFrame on top of them with **column_frame()**, so the numeric columns are read from disk only when they are used and never copied into memory; only the integer codes of the dictionary encoded columns are loaded, since pandas narrows them to a smaller integer type (or use **dataframe=False** to get the memory mapped arrays and the lists of strings as they are). **mmap=False** reads every column into memory instead. Fixed point coordinates are exported as **lat_e7** and **lon_e7**, with their **scale** (1e-7) and the value that marks a missing one in **_meta.json**; **read_table()** turns the missing ones into NA. If **pyarrow** is installed, **format="parquet"** writes Parquet files instead, which have the same row group statistics built in. 
+
+# In[ ]:
+
+class TagStore(ColumnStore):
+    # typed columns for the cleaned <tag> rows of nodes or ways
+    def __init__(self, tag, cleaner=None):
+        self.tags = (tag,)
+        self.cleaner = cleaner
+        self.columns = OrderedDict([('id', Column(np.int64)), ('attribute', DictColumn()), ('attribute_type', DictColumn()),
+                                    ('value', DictColumn())])
+    def visit(self, elem):
+        clean = (self.cleaner or tag_cleaner).clean
+        elem_id = int(elem.attrib['id'])
+        columns = self.columns
+        for tag in elem.iter("tag"):
+            row = clean(tag.attrib['k'], tag.attrib['v'])
+            if row is not None:
+                attribute, attribute_type, value = row
+                columns['id'].append(elem_id)
+                columns['attribute'].append(attribute)
+                columns['attribute_type'].append(attribute_type or 'NA')
+                columns['value'].append(as_text(value))
+    def empty(self):
+        return TagStore(self.tags[0], self.cleaner)
+
+def column_stats(values, missing=None):
+    if missing is not None: values = values[values != missing]
+    if len(values) == 0: return None
+    if values.dtype.kind == 'f':
+        if np.isnan(values).all(): return None
+        return [float(np.nanmin(values)), float(np.nanmax(values))]
+    return [int(values.min()), int(values.max())]
+
+def write_store(store, directory, row_group_size=1000000, format="npy"):
+    if not os.path.isdir(directory): os.makedirs(directory)
+    if format == "parquet":
+        if pa is None: raise ImportError("format='parquet' needs pyarrow")
+        # the missing values become nulls, the fixed point columns keep their _e7 names
+        arrays = []
+        for col in store.names():
+            column = store.columns[col]
+            if isinstance(column, DictColumn): arrays.append(pa.Array.from_pandas(column.values()))
+            else:
+                values = column.values()
+                arrays.append(pa.Array.from_pandas(values, mask=values == column.missing if column.missing is not None else None))
+        table = pa.Table.from_arrays(arrays, [store.label(col) for col in store.names()])
+        pq.write_table(table, os.path.join(directory, "table.parquet"), row_group_size=row_group_size)
+        return
+    rows = len(store)
+    meta = {'rows': rows, 'row_group_size': row_group_size, 'columns': OrderedDict(), 'row_groups': []}
+    for col in store.names():
+        column, name = store.columns[col], store.label(col)
+        if isinstance(column, DictColumn):
+            np.save(os.path.join(directory, name + ".codes.npy"), column.codes.values())
+            with open(os.path.join(directory, name + ".categories.json"), "w") as f:
+                json.dump(column.categories, f)
+            meta['columns'][name] = {'kind': 'dict', 'dtype': 'int32'}
+        else:
+            np.save(os.path.join(directory, name + ".npy"), column.values())
+            meta['columns'][name] = {'kind': 'array', 'dtype': str(column.data.dtype)}
+            if column.missing is not None: meta['columns'][name]['missing'] = int(column.missing)
+            if column.scale is not None: meta['columns'][name]['scale'] = column.scale
+    for start in range(0, rows, row_group_size):
+        stats = OrderedDict()
+        for col in store.names():
+            column = store.columns[col]
+            if not isinstance(column, DictColumn):
+                stats[store.label(col)] = column_stats(column.values()[start:start + row_group_size], column.missing)
+        meta['row_groups'].append({'start': start, 'rows': min(row_group_size, rows - start), 'stats': stats})
+    with open(os.path.join(directory, "_meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+
+def read_table(directory, mmap=True, dataframe=True):
+    if os.path.exists(os.path.join(directory, "table.parquet")):
+        table = pq.read_table(os.path.join(directory, "table.parquet"), memory_map=mmap)
+        return table.to_pandas() if dataframe else table
+    with open(os.path.join(directory, "_meta.json")) as f:
+        meta = json.load(f, object_pairs_hook=OrderedDict)
+    mode = 'r' if mmap else None
+    data = OrderedDict()
+    for col, info in meta['columns'].iteritems():
+        if info['kind'] == 'dict':
+            codes = np.load(os.path.join(directory, col + ".codes.npy"), mmap_mode=mode)
+            with open(os.path.join(directory, col + ".categories.json")) as f:
+                categories = json.load(f)
+            data[col] = pd.Categorical.from_codes(codes, categories) if dataframe else (codes, categories)
+        else:
+            values = np.load(os.path.join(directory, col + ".npy"), mmap_mode=mode)
+            data[col] = masked(values, info.get('missing')) if dataframe else values
+    return column_frame(data) if dataframe else data
+
+def export_tables(directory="export", filename=None, format="npy", fixed_point=False, row_group_size=1000000):
+    stores = run_pass([NodeStore(fixed_point), ElementStore("way"), TagStore("node"), TagStore("way")], filename)
+    for name, store in zip(["nodes", "ways", "nodes_tags", "ways_tags"], stores):
+        write_store(store, os.path.join(directory, name), row_group_size, format)
+    return dict((name, len(store)) for name, store in zip(["nodes", "ways", "nodes_tags", "ways_tags"], stores))
+
+
 # # Converting the CSV to DB Using SQL
 
 # In this section, I will convert the CSV format to SQL database and run a few queries to extract some information and answer some questions that I posed at the beginning. There are multiple ways of doing this, the way that I chose was to first create a table (or schema) with desired data taypes and then loop through every row of the previously saved CSV files, convert the columns data type to the types determined in the schema and insert them into the database. I chose to re-open the CSV file again for instructional purposes as loading a CSV file into a database is a quite common practice. 
@@ -462,6 +1870,1006 @@ con.commit()
 quer("PRAGMA table_info(ways_tags)")
 
 
+# The CSV round trip above is kept for instructional purposes, but it is slow: the tables are built in pandas, written to CSV and then read back line by line. The loader below skips all of that and streams the parsed elements straight into the database in the same single pass. The rows are inserted with **executemany** in batches, all inside a few large transactions, and a few PRAGMAs that speed up bulk inserts (no rollback journal, no fsync, a bigger page cache) are switched on for the load only and restored afterwards. The secondary indexes used by the analysis queries are built once at the end of the load. A database that already holds elements is refused before anything is written, since loading it again would add every row a second time: **replace=True** starts over, and **apply_changes()** updates it. With **intern_strings=True** the attribute, attribute_type and value columns of the tag tables store integer ids into a **tag_strings** dictionary table, which makes the tables and their indexes much smaller; the **nodes_tags_text** and **ways_tags_text** views show them as text again. Parsing and inserting also overlap: with **threaded=True** (the default when there is more than one core) the batches of rows go to a **ThreadedDBWriter**, whose thread has its own connection, runs the inserts and commits them in large transactions while the parser goes on with the next elements. The queue between the two holds at most **queue_size** batches, so when the disk is slow the parser waits instead of filling the memory; **Metrics** shows the length of the queue as the **write_queue** gauge and the time the parser spent waiting for it as the **wait:write** stage. sqlite3 releases the GIL while SQLite works, so the load takes about as long as the slower of the two instead of their sum. 
+
+# In[ ]:
+
+db_schema = [
+    ('nodes', ['changeset', 'node_id', 'lat', 'lon', 'timestamp', 'user_id', 'user', 'version'],
+     '''CREATE TABLE IF NOT EXISTS nodes (
+    id  INTEGER PRIMARY KEY NOT NULL,
+    changeset INTEGER,
+    node_id INTEGER,
+    lat FLOAT,
+    lon FLOAT,
+    timestamp TIMESTAMP,
+    user_id INTEGER,
+    user TEXT,
+    version INTEGER);'''),
+    ('ways', ['changeset', 'way_id', 'timestamp', 'user_id', 'user', 'version'],
+     '''CREATE TABLE IF NOT EXISTS ways (
+    id  INTEGER PRIMARY KEY NOT NULL,
+    changeset INTEGER,
+    way_id INTEGER,
+    timestamp TIMESTAMP,
+    user_id INTEGER,
+    user TEXT,
+    version INTEGER);'''),
+    ('nodes_tags', ['attribute', 'attribute_type', 'node_id', 'data_type', 'value'],
+     '''CREATE TABLE IF NOT EXISTS nodes_tags (
+    id  INTEGER PRIMARY KEY NOT NULL,
+    attribute TEXT,
+    attribute_type TEXT,
+    node_id INTEGER,
+    data_type TEXT,
+    value TEXT);'''),
+    ('ways_tags', ['attribute', 'attribute_type', 'way_id', 'data_type', 'value'],
+     '''CREATE TABLE IF NOT EXISTS ways_tags (
+    id  INTEGER PRIMARY KEY NOT NULL,
+    attribute TEXT,
+    attribute_type TEXT,
+    way_id INTEGER,
+    data_type TEXT,
+    value TEXT);'''),
+    ('ways_nodes', ['way_id', 'node_id', 'position'],
+     '''CREATE TABLE IF NOT EXISTS ways_nodes (
+    way_id INTEGER,
+    node_id INTEGER,
+    position INTEGER);'''),
+    ('relations', ['changeset', 'relation_id', 'timestamp', 'user_id', 'user', 'version'],
+     '''CREATE TABLE IF NOT EXISTS relations (
+    id  INTEGER PRIMARY KEY NOT NULL,
+    changeset INTEGER,
+    relation_id INTEGER,
+    timestamp TIMESTAMP,
+    user_id INTEGER,
+    user TEXT,
+    version INTEGER);'''),
+    ('relations_tags', ['attribute', 'attribute_type', 'relation_id', 'data_type', 'value'],
+     '''CREATE TABLE IF NOT EXISTS relations_tags (
+    id  INTEGER PRIMARY KEY NOT NULL,
+    attribute TEXT,
+    attribute_type TEXT,
+    relation_id INTEGER,
+    data_type TEXT,
+    value TEXT);'''),
+    ('relation_members', ['relation_id', 'member_type', 'member_ref', 'role', 'position'],
+     '''CREATE TABLE IF NOT EXISTS relation_members (
+    relation_id INTEGER,
+    member_type TEXT,
+    member_ref INTEGER,
+    role TEXT,
+    position INTEGER);''')]
+
+db_cols = dict((table, cols) for table, cols, _ in db_schema)
+tag_tables = [("nodes_tags", "node_id"), ("ways_tags", "way_id"), ("relations_tags", "relation_id")]
+
+# with intern_strings=True the tag tables hold integer ids into tag_strings instead of the text itself
+interned_tags_schema = {}
+for table, id_col in tag_tables:
+    interned_tags_schema[table] = '''CREATE TABLE IF NOT EXISTS {0} (
+    id  INTEGER PRIMARY KEY NOT NULL,
+    attribute INTEGER,
+    attribute_type INTEGER,
+    {1} INTEGER,
+    data_type TEXT,
+    value INTEGER);'''.format(table, id_col)
+# the {table}_text views give back the text columns of an interned table
+text_view = '''CREATE VIEW IF NOT EXISTS {0}_text AS
+    SELECT t.id, a.text AS attribute, y.text AS attribute_type, t.{1}, t.data_type, v.text AS value FROM {0} t
+    JOIN tag_strings a ON a.id = t.attribute JOIN tag_strings y ON y.id = t.attribute_type JOIN tag_strings v ON v.id = t.value;'''
+
+# secondary indexes, built after the bulk load: element lookups by id, covering indexes for the
+# per user counts and for filtering tags on attribute and value
+db_indexes = [("nodes", "node_id"), ("ways", "way_id"), ("nodes", "user_id, user"), ("ways", "user_id, user"),
+              ("nodes_tags", "node_id"), ("ways_tags", "way_id"),
+              ("nodes_tags", "attribute, value, node_id"), ("ways_tags", "attribute, value, way_id"),
+              ("ways_nodes", "way_id"), ("ways_nodes", "node_id"),
+              ("relations", "relation_id"), ("relations_tags", "relation_id"), ("relations_tags", "attribute, value, relation_id"),
+              ("relation_members", "relation_id"), ("relation_members", "member_type, member_ref")]
+
+class StringIds(object):
+    # gives every distinct attribute/value string an integer id, stored in the tag_strings table
+    # with a writer the ids are handed out here and the new strings are inserted through the writer
+    def __init__(self, con, writer=None):
+        self.con = con
+        self.writer = writer
+        con.execute("CREATE TABLE IF NOT EXISTS tag_strings (id INTEGER PRIMARY KEY, text TEXT UNIQUE)")
+        self.ids = dict((text, string_id) for string_id, text in con.execute("SELECT id, text FROM tag_strings"))
+        self.next_id = max(self.ids.itervalues()) + 1 if self.ids else 1
+    def __call__(self, text):
+        if not isinstance(text, basestring): text = str(text)
+        try:
+            return self.ids[text]
+        except KeyError:
+            if self.writer is not None:
+                string_id = self.next_id
+                self.next_id += 1
+                self.writer.add("tag_strings", (string_id, text))
+            else: string_id = self.con.execute("INSERT INTO tag_strings (text) VALUES (?)", (text,)).lastrowid
+            self.ids[text] = string_id
+            return string_id
+
+def is_interned(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tag_strings'").fetchone() is not None
+
+def loaded_tables(con):
+    # the element tables that already hold rows
+    tables = set(name for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    return [table for table, _, _ in db_schema
+            if table in tables and con.execute("SELECT 1 FROM {} LIMIT 1".format(table)).fetchone() is not None]
+
+def create_tables(con, replace=False, intern_strings=False, summaries=False):
+    if replace:
+        for table, _ in tag_tables: con.execute("DROP VIEW IF EXISTS {}_text".format(table))
+        con.execute("DROP TABLE IF EXISTS tag_strings")
+        for table, _, _ in summary_schema: con.execute("DROP TABLE IF EXISTS {}".format(table))
+        con.execute("DROP TABLE IF EXISTS way_geometry")
+        con.execute("DROP TABLE IF EXISTS relation_geometry")
+    con.execute(geometry_schema)
+    con.execute(relation_geometry_schema)
+    if summaries:
+        for _, _, create in summary_schema: con.execute(create)
+    for table, _, create in db_schema:
+        if replace: con.execute("DROP TABLE IF EXISTS {}".format(table))
+        con.execute(interned_tags_schema[table] if intern_strings and table in interned_tags_schema else create)
+    if intern_strings:
+        con.execute("CREATE TABLE IF NOT EXISTS tag_strings (id INTEGER PRIMARY KEY, text TEXT UNIQUE)")
+        for table, id_col in tag_tables:
+            con.execute(text_view.format(table, id_col))
+    con.commit()
+
+def create_indexes(con):
+    for table, cols in db_indexes:
+        con.execute("CREATE INDEX IF NOT EXISTS {}_{} ON {} ({})".format(table, cols.replace(", ", "_"), table, cols))
+    con.commit()
+
+def analyze_db(con, full=True):
+    # lets the query planner know how selective the indexes are. A full ANALYZE reads every table, after a small
+    # update PRAGMA optimize only analyzes what changed enough to matter (and does nothing before SQLite 3.18)
+    con.execute("ANALYZE" if full else "PRAGMA optimize")
+    con.commit()
+
+def tag_row(elem_id, row, strings=None):
+    attribute, attribute_type, value = row
+    attribute_type = attribute_type or 'NA'
+    if strings is not None: return (strings(attribute), strings(attribute_type), elem_id, None, strings(value))
+    return (attribute, attribute_type, elem_id, None, value)
+
+def insert_sql(table, cols):
+    return "INSERT INTO {} ({}) VALUES ({});".format(table, ",".join(cols), ",".join("?" * len(cols)))
+
+bulk_pragmas = [('journal_mode', 'OFF'), ('synchronous', 'OFF'), ('cache_size', '-200000')]
+
+class DBWriter(object):
+    # buffers rows per table, inserts them with executemany in batches and commits every commit_rows rows
+    def __init__(self, con, schema=db_schema, batch_size=10000, commit_rows=1000000, metrics=None):
+        self.con = con
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.commit_rows = commit_rows
+        self.pending = 0
+        self.rows = {}
+        self.inserts = {}
+        for table, cols, _ in schema:
+            self.rows[table] = []
+            self.inserts[table] = insert_sql(table, cols)
+    def add(self, table, row):
+        rows = self.rows[table]
+        rows.append(row)
+        if len(rows) >= self.batch_size: self.flush(table)
+    def flush(self, table):
+        rows = self.rows[table]
+        if rows:
+            with timed_stage(self.metrics, "write"): self.con.executemany(self.inserts[table], rows)
+            self.pending += len(rows)
+            del rows[:]
+        if self.pending >= self.commit_rows:
+            with timed_stage(self.metrics, "write"): self.con.commit()
+            self.pending = 0
+    def close(self):
+        for table in self.rows: self.flush(table)
+        with timed_stage(self.metrics, "write"): self.con.commit()
+    # drops the rows that were not inserted yet, after a failed pass
+    def abort(self):
+        for rows in self.rows.itervalues(): del rows[:]
+
+class ThreadedDBWriter(DBWriter):
+    # the parsing thread only fills the batches, a writer thread with its own connection inserts and commits them
+    def __init__(self, db, schema=db_schema, batch_size=10000, commit_rows=1000000, metrics=None, queue_size=8,
+                 pragmas=bulk_pragmas):
+        DBWriter.__init__(self, None, schema, batch_size, commit_rows, metrics)
+        self.db = db
+        self.pragmas = pragmas
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+        self.aborted = False
+        self.thread = threading.Thread(target=self.write_batches)
+        self.thread.daemon = True
+        self.thread.start()
+    def depth(self):
+        return self.queue.qsize()
+    def raise_error(self):
+        if self.error is not None: raise self.error[0], self.error[1], self.error[2]
+    def put(self, item):
+        start = time.time()
+        # waits while the queue is full, so the parser can not run ahead of the writer by more than queue_size batches,
+        # but gives up as soon as the writer has failed or stopped
+        while True:
+            self.raise_error()
+            if not self.thread.is_alive(): raise RuntimeError("the writer thread has stopped")
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+        if self.metrics is not None:
+            self.metrics.add_time("wait:write", time.time() - start)
+            self.metrics.gauge("write_queue", self.depth())
+    def flush(self, table):
+        rows = self.rows[table]
+        if rows:
+            # the list now belongs to the writer thread
+            self.rows[table] = []
+            self.put((table, rows))
+    def write_batches(self):
+        con = None
+        stopped = False
+        try:
+            con = sqlite3.connect(self.db)
+            con.text_factory = str
+            set_pragmas(con, self.pragmas)
+            pending = 0
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    stopped = True
+                    break
+                if self.aborted: continue
+                table, rows = item
+                with timed_stage(self.metrics, "write"):
+                    con.executemany(self.inserts[table], rows)
+                    pending += len(rows)
+                    if pending >= self.commit_rows:
+                        con.commit()
+                        pending = 0
+            if not self.aborted:
+                with timed_stage(self.metrics, "write"): con.commit()
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            if con is not None: con.close()
+            # whatever went wrong, the batches are still taken off the queue until the end, so nobody blocks on it
+            while not stopped: stopped = self.queue.get() is None
+    def stop(self):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+        self.thread.join()
+    def close(self):
+        try:
+            for table in self.rows: self.flush(table)
+        finally:
+            self.stop()
+        self.raise_error()
+    def abort(self):
+        self.aborted = True
+        DBWriter.abort(self)
+        self.stop()
+
+def element_row(elem, id_col=True):
+    a = elem.attrib
+    if id_col: return (a.get('changeset'), a.get('id'), a.get('lat'), a.get('lon'), a.get('timestamp'), a.get('uid'), a.get('user'), a.get('version'))
+    return (a.get('changeset'), a.get('id'), a.get('timestamp'), a.get('uid'), a.get('user'), a.get('version'))
+
+class MemberRows(Visitor):
+    tags = ("relation",)
+    def __init__(self, writer):
+        self.writer = writer
+        self.count = 0
+    def visit(self, elem):
+        relation_id = elem.attrib['id']
+        for position, member in enumerate(elem.iter("member")):
+            a = member.attrib
+            self.writer.add("relation_members", (relation_id, a.get('type'), a.get('ref'), a.get('role'), position))
+            self.count += 1
+    def result(self):
+        return self.count
+
+class ElementRows(Visitor):
+    def __init__(self, tag, writer):
+        self.tags = (tag,)
+        self.table = tag + "s"
+        self.writer = writer
+        self.count = 0
+    def visit(self, elem):
+        self.writer.add(self.table, element_row(elem, elem.tag == "node"))
+        self.count += 1
+    def result(self):
+        return self.count
+
+class TagsRows(Visitor):
+    def __init__(self, tag, writer, cleaner=None, strings=None):
+        self.tags = (tag,)
+        self.table = tag + "s_tags"
+        self.writer = writer
+        self.cleaner = cleaner
+        self.strings = strings
+        self.count = 0
+    def visit(self, elem):
+        elem_id = elem.attrib['id']
+        clean = (self.cleaner or tag_cleaner).clean
+        for tag in elem.iter("tag"):
+            row = clean(tag.attrib['k'], tag.attrib['v'])
+            if row is not None:
+                self.writer.add(self.table, tag_row(elem_id, row, self.strings))
+                self.count += 1
+    def result(self):
+        return self.count
+
+def set_pragmas(con, pragmas):
+    # sets the given PRAGMAs and returns their previous values so they can be restored
+    old = []
+    for name, value in pragmas:
+        old.append((name, con.execute("PRAGMA {}".format(name)).fetchone()[0]))
+        con.execute("PRAGMA {} = {}".format(name, value))
+    return old
+
+def load_db(db='osm.db', filename=None, replace=False, batch_size=10000, profile=None, intern_strings=False, indexes=True,
+            summaries=True, spatial=True, geometry=True, multipolygons=False, metrics=None, backend=None, threaded=None):
+    con = sqlite3.connect(db)
+    con.text_factory = str
+    try:
+        # loading the file again on top of a loaded database would add every row a second time
+        loaded = [] if replace else loaded_tables(con)
+        if loaded:
+            raise ValueError("{} already holds {}, load it with replace=True or update it with apply_changes()".format(
+                db, ", ".join(loaded)))
+        create_tables(con, replace, intern_strings, summaries)
+        old = set_pragmas(con, bulk_pragmas)
+        try:
+            # the new tag strings go through the writer too, so only one connection writes during the pass
+            schema = db_schema + [("tag_strings", ["id", "text"], None)]
+            # with one core the two threads would only take turns, and an in-memory database can not be opened
+            # a second time from the writer thread
+            if threaded is None: threaded = multiprocessing.cpu_count() > 1
+            if threaded and db != ":memory:": writer = ThreadedDBWriter(db, schema, batch_size=batch_size, metrics=metrics)
+            else: writer = DBWriter(con, schema, batch_size=batch_size, metrics=metrics)
+            cleaner = TagCleaner(profile=profile) if profile is not None else None
+            if metrics is not None: cleaner = metrics.instrument(cleaner)
+            strings = StringIds(con, writer) if is_interned(con) else None
+            visitors = [ElementRows("node", writer), ElementRows("way", writer),
+                        TagsRows("node", writer, cleaner, strings), TagsRows("way", writer, cleaner, strings)]
+            refs = WayRefs(writer, keep=geometry)
+            relation_visitors = [ElementRows("relation", writer), TagsRows("relation", writer, cleaner, strings), MemberRows(writer)]
+            coords = NodeCoords() if geometry else None
+            summary = SummaryCounter(cleaner) if summaries else None
+            try:
+                run_pass(visitors + relation_visitors + [v for v in (refs, coords, summary) if v is not None], filename,
+                         metrics=metrics, backend=backend)
+            except:
+                writer.abort()
+                raise
+            counts = [visitor.result() for visitor in visitors] + [refs.count] + [visitor.result() for visitor in relation_visitors]
+            writer.close()
+            if summary is not None:
+                with timed_stage(metrics, "summaries"):
+                    summary.write(con)
+                    con.commit()
+            if geometry:
+                with timed_stage(metrics, "geometry"):
+                    write_way_geometry(con, way_geometry(refs, coords))
+                    con.commit()
+            # indexes are much cheaper to build once at the end than to keep up to date row by row
+            with timed_stage(metrics, "index"):
+                if indexes:
+                    create_indexes(con)
+                    analyze_db(con)
+                if spatial: create_rtree(con)
+            if multipolygons:
+                with timed_stage(metrics, "multipolygons"): assemble_multipolygons(con)
+        finally:
+            set_pragmas(con, old)
+    finally:
+        con.close()
+        # the stages after the pass (summaries, geometry, index) end up in the file too
+        if metrics is not None: metrics.flush()
+    return dict(zip([table for table, _, _ in db_schema], counts))
+
+
+# The questions we answer at the end are always the same aggregates: contributions per user, per zip code and per attribute type, and building types per zip code. Rather than scanning the tag tables for each of them, **SummaryCounter** keeps these counts while the elements stream through the loader and writes them to a few small summary tables at the end (**user_counts**, **postcode_counts**, **attribute_type_counts**, **building_counts** and **zipcode_buildings**). **apply_changes()** keeps them up to date as well. 
+
+# In[ ]:
+
+summary_schema = [
+    ('user_counts', ['user_id', 'user', 'count'],
+     "CREATE TABLE IF NOT EXISTS user_counts (user_id INTEGER PRIMARY KEY, user TEXT, count INTEGER);"),
+    ('postcode_counts', ['postcode', 'count'],
+     "CREATE TABLE IF NOT EXISTS postcode_counts (postcode TEXT PRIMARY KEY, count INTEGER);"),
+    ('attribute_type_counts', ['attribute_type', 'count'],
+     "CREATE TABLE IF NOT EXISTS attribute_type_counts (attribute_type TEXT PRIMARY KEY, count INTEGER);"),
+    ('building_counts', ['building', 'count'],
+     "CREATE TABLE IF NOT EXISTS building_counts (building TEXT PRIMARY KEY, count INTEGER);"),
+    ('zipcode_buildings', ['zipcode', 'building', 'count'],
+     "CREATE TABLE IF NOT EXISTS zipcode_buildings (zipcode TEXT, building TEXT, count INTEGER, PRIMARY KEY (zipcode, building));")]
+db_summary_cols = dict((table, cols) for table, cols, _ in summary_schema)
+
+def as_text(value):
+    return value if isinstance(value, basestring) else str(value)
+
+# INSERT ... ON CONFLICT DO UPDATE needs SQLite 3.24, older ones get the row first and update it after
+sqlite_upsert = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+def add_db_counts(con, table, keys, rows, columns=()):
+    # rows are (keys..., columns..., count), the count is added to the row of the keys and the columns are overwritten
+    names = ", ".join(list(keys) + list(columns) + ["count"])
+    marks = ",".join("?" * (len(keys) + len(columns) + 1))
+    if sqlite_upsert:
+        con.executemany("INSERT INTO {0} ({1}) VALUES ({2}) ON CONFLICT({3}) DO UPDATE SET count = count + excluded.count{4};".format(
+            table, names, marks, ", ".join(keys), "".join(", {0} = excluded.{0}".format(col) for col in columns)), rows)
+        return
+    con.executemany("INSERT OR IGNORE INTO {0} ({1}) VALUES ({2});".format(table, names, marks),
+                    [row[:-1] + (0,) for row in rows])
+    con.executemany("UPDATE {0} SET count = count + ?{1} WHERE {2};".format(
+        table, "".join(", {} = ?".format(col) for col in columns), " AND ".join("{} IS ?".format(key) for key in keys)),
+        [(row[-1],) + tuple(row[len(keys):-1]) + tuple(row[:len(keys)]) for row in rows])
+
+class SummaryCounter(Visitor):
+    tags = ("node", "way")
+    def __init__(self, cleaner=None):
+        self.cleaner = cleaner
+        self.users = defaultdict(int)
+        self.user_names = {}
+        self.postcodes = defaultdict(int)
+        self.attribute_types = defaultdict(int)
+        self.buildings = defaultdict(int)
+        self.zipcode_buildings = defaultdict(int)
+    # rows are the cleaned (attribute, attribute_type, value) of the element, sign=-1 takes an element out again
+    def add(self, kind, uid, user, rows, sign=1):
+        if uid is not None:
+            uid = int(uid)
+            self.users[uid] += sign
+            self.user_names[uid] = user
+        zipcodes, buildings = [], []
+        for attribute, attribute_type, value in rows:
+            self.attribute_types[attribute_type or 'NA'] += sign
+            if attribute == 'postcode':
+                self.postcodes[as_text(value)] += sign
+                zipcodes.append(as_text(value))
+            elif attribute == 'building' and kind == "way":
+                self.buildings[as_text(value)] += sign
+                buildings.append(as_text(value))
+        # same pairs as joining the zipcodes and buildings of a way on way_id
+        for zipcode in zipcodes:
+            for building in buildings: self.zipcode_buildings[(zipcode, building)] += sign
+    def visit(self, elem):
+        clean = (self.cleaner or tag_cleaner).clean
+        rows = [row for row in (clean(tag.attrib['k'], tag.attrib['v']) for tag in elem.iter("tag")) if row is not None]
+        self.add(elem.tag, elem.attrib.get('uid'), elem.attrib.get('user'), rows)
+    def empty(self):
+        return SummaryCounter(self.cleaner)
+    def merge(self, other):
+        for name in ('users', 'postcodes', 'attribute_types', 'buildings', 'zipcode_buildings'):
+            add_counts(getattr(self, name), getattr(other, name))
+        self.user_names.update(other.user_names)
+    def result(self):
+        return self
+    # adds the counts to the summary tables, rows whose count drops to zero are removed
+    def write(self, con):
+        add_db_counts(con, 'user_counts', ['user_id'],
+                      [(uid, self.user_names[uid], count) for uid, count in self.users.iteritems() if count], ['user'])
+        for table, counts in (('postcode_counts', self.postcodes), ('attribute_type_counts', self.attribute_types),
+                              ('building_counts', self.buildings)):
+            add_db_counts(con, table, db_summary_cols[table][:1], [(value, count) for value, count in counts.iteritems() if count])
+        add_db_counts(con, 'zipcode_buildings', ['zipcode', 'building'],
+                      [(zipcode, building, count) for (zipcode, building), count in self.zipcode_buildings.iteritems() if count])
+        for table, _, _ in summary_schema: con.execute("DELETE FROM {} WHERE count <= 0".format(table))
+
+def has_summaries(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_counts'").fetchone() is not None
+
+
+# The nodes come with their latitude and longitude, so we can also ask where the contributions are. To avoid scanning all the nodes for every map tile, the loader builds an SQLite **R*Tree** index (**nodes_rtree**) over the node coordinates, and **bbox_count()** and **radius_nodes()** use it to count the nodes in a box or find those within some distance of a point. R*Tree boxes are stored as 32 bit floats, so the candidates are checked again against the exact coordinates in **nodes**. For heatmaps, **GridIndex** does the same in memory on the columns of a **NodeStore**: it sorts the points by grid cell, so a box or radius query only looks at the cells it covers, and **density()** gives the number of nodes in every cell. 
+
+# In[ ]:
+
+rtree_schema = "CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);"
+
+def has_rtree(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone() is not None
+
+def create_rtree(con):
+    con.execute("DROP TABLE IF EXISTS nodes_rtree")
+    con.execute(rtree_schema)
+    con.execute("INSERT INTO nodes_rtree SELECT node_id, lat, lat, lon, lon FROM nodes WHERE lat IS NOT NULL AND lon IS NOT NULL")
+    con.commit()
+
+def bbox_count(con, min_lat, min_lon, max_lat, max_lon):
+    return con.execute('''SELECT count(*) FROM nodes_rtree r JOIN nodes n ON n.node_id = r.id
+        WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+        AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?''',
+        (min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon)).fetchone()[0]
+
+earth_radius = 6371000.0
+
+def degrees_around(lat, meters):
+    # half size in degrees of a box that contains the circle of the given radius
+    dlat = math.degrees(meters / earth_radius)
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    return dlat, dlon
+
+def haversine(lat1, lon1, lat2, lon2):
+    # distance in meters, works with numbers or numpy arrays
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(a))
+
+def radius_nodes(con, lat, lon, meters):
+    # (node_id, lat, lon, distance) of the nodes within meters of the point, nearest first
+    dlat, dlon = degrees_around(lat, meters)
+    rows = con.execute('''SELECT n.node_id, n.lat, n.lon FROM nodes_rtree r JOIN nodes n ON n.node_id = r.id
+        WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?''',
+        (lat - dlat, lat + dlat, lon - dlon, lon + dlon)).fetchall()
+    found = [(node_id, n_lat, n_lon, float(haversine(lat, lon, n_lat, n_lon))) for node_id, n_lat, n_lon in rows]
+    return sorted([row for row in found if row[3] <= meters], key=lambda row: row[3])
+
+class GridIndex(object):
+    # points bucketed into cells of cell x cell degrees and sorted by cell
+    def __init__(self, lat, lon, cell=0.01):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        self.cell = cell
+        # points without coordinates (NaN) end up in the first cell and never match a query
+        self.min_lat, self.min_lon = np.nanmin(lat), np.nanmin(lon)
+        self.rows = int((np.nanmax(lat) - self.min_lat) // cell) + 1
+        self.cols = int((np.nanmax(lon) - self.min_lon) // cell) + 1
+        keys = self.row_of(lat) * self.cols + self.col_of(lon)
+        self.order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[self.order]
+        self.lat = lat[self.order]
+        self.lon = lon[self.order]
+    @classmethod
+    def from_store(cls, store, cell=0.01):
+        if not getattr(store, 'fixed_point', False): return cls(store.column('lat'), store.column('lon'), cell)
+        lat, lon = store.column('lat'), store.column('lon')
+        found = (lat != missing_e7) & (lon != missing_e7)
+        return cls(np.where(found, lat * 1e-7, np.nan), np.where(found, lon * 1e-7, np.nan), cell)
+    def row_of(self, lat):
+        return np.clip(((np.asarray(lat) - self.min_lat) // self.cell).astype(np.int64), 0, self.rows - 1)
+    def col_of(self, lon):
+        return np.clip(((np.asarray(lon) - self.min_lon) // self.cell).astype(np.int64), 0, self.cols - 1)
+    def candidates(self, min_lat, min_lon, max_lat, max_lon):
+        # positions (in sorted order) of the points in the cells touching the box
+        c0, c1 = int(self.col_of(min_lon)), int(self.col_of(max_lon))
+        parts = []
+        for row in range(int(self.row_of(min_lat)), int(self.row_of(max_lat)) + 1):
+            start, end = np.searchsorted(self.keys, [row * self.cols + c0, row * self.cols + c1 + 1])
+            if end > start: parts.append(np.arange(start, end))
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        # indices (into the arrays given to the index) of the points inside the box
+        pos = self.candidates(min_lat, min_lon, max_lat, max_lon)
+        lat, lon = self.lat[pos], self.lon[pos]
+        inside = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+        return self.order[pos[inside]]
+    def bbox_count(self, min_lat, min_lon, max_lat, max_lon):
+        return len(self.bbox(min_lat, min_lon, max_lat, max_lon))
+    def radius(self, lat, lon, meters):
+        # indices of the points within meters of the point and their distances
+        dlat, dlon = degrees_around(lat, meters)
+        pos = self.candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        distance = haversine(lat, lon, self.lat[pos], self.lon[pos])
+        inside = distance <= meters
+        return self.order[pos[inside]], distance[inside]
+    def density(self):
+        # number of points per cell, rows go north from min_lat and columns east from min_lon
+        return np.bincount(self.keys, minlength=self.rows * self.cols).reshape(self.rows, self.cols)
+
+
+# The **<nd ref>** children of a way list the nodes it goes through, but so far we dropped them, so the ways had no location. The loader now keeps them in a **ways_nodes** table (way_id, node_id, position) and also computes a simple geometry for every way: the centroid of its nodes and its bounding box, stored in **way_geometry**. To look up the coordinates of tens of millions of node references without a Python dictionary per node, **NodeCoords** keeps only the node ids and fixed point coordinates in two numpy arrays (16 bytes per node), sorted by id, and the references are found with a binary search (**np.searchsorted**) all at once. **apply_changes()** recomputes the geometry of the ways that change or whose nodes move. 
+
+# In[ ]:
+
+geometry_schema = '''CREATE TABLE IF NOT EXISTS way_geometry (
+    way_id INTEGER PRIMARY KEY NOT NULL,
+    nodes INTEGER,
+    centroid_lat FLOAT,
+    centroid_lon FLOAT,
+    min_lat FLOAT,
+    min_lon FLOAT,
+    max_lat FLOAT,
+    max_lon FLOAT);'''
+
+class NodeCoords(NodeStore):
+    # just the node ids and their fixed point coordinates
+    int_cols = [('id', np.int64)]
+    dict_cols = []
+    def __init__(self):
+        NodeStore.__init__(self, fixed_point=True)
+    def empty(self):
+        return NodeCoords()
+    # (found, lat, lon) for an array of node ids, lat and lon are in degrees
+    def lookup(self, refs):
+        ids, lat, lon = self.column('id'), self.column('lat'), self.column('lon')
+        refs = np.asarray(refs, dtype=np.int64)
+        if len(ids) == 0: return np.zeros(len(refs), dtype=bool), np.zeros(len(refs)), np.zeros(len(refs))
+        # OSM files list the nodes by id, so this sort is usually skipped
+        if not (ids[1:] > ids[:-1]).all():
+            order = np.argsort(ids, kind='mergesort')
+            ids, lat, lon = ids[order], lat[order], lon[order]
+        pos = np.minimum(np.searchsorted(ids, refs), len(ids) - 1)
+        lat, lon = lat[pos], lon[pos]
+        return (ids[pos] == refs) & (lat != missing_e7) & (lon != missing_e7), lat * 1e-7, lon * 1e-7
+
+class WayRefs(Visitor):
+    # the node references of every way, as three flat arrays instead of a list per way
+    tags = ("way",)
+    def __init__(self, writer=None, keep=True):
+        self.writer = writer
+        self.keep = keep
+        self.way_ids = Column(np.int64)
+        self.counts = Column(np.int32)
+        self.refs = Column(np.int64)
+        self.count = 0
+    def visit(self, elem):
+        way_id = int(elem.attrib['id'])
+        refs = [int(nd.attrib['ref']) for nd in elem.iter("nd")]
+        if self.writer is not None:
+            for position, ref in enumerate(refs): self.writer.add("ways_nodes", (way_id, ref, position))
+        if self.keep:
+            self.way_ids.append(way_id)
+            self.counts.append(len(refs))
+            self.refs.extend(refs)
+        self.count += len(refs)
+    def empty(self):
+        return WayRefs(None, self.keep)
+    def merge(self, other):
+        self.way_ids.extend(other.way_ids.values())
+        self.counts.extend(other.counts.values())
+        self.refs.extend(other.refs.values())
+        self.count += other.count
+    def result(self):
+        return self
+
+def way_geometry(refs, coords):
+    # centroid and bounding box of every way that has at least one node with known coordinates
+    counts = refs.counts.values().astype(np.int64)
+    found, lat, lon = coords.lookup(refs.refs.values())
+    starts = np.cumsum(counts) - counts
+    # reduceat needs the start of every non empty way, empty ways have no geometry anyway
+    keep = counts > 0
+    if not keep.any(): return OrderedDict((col, np.empty(0)) for col in ('way_id', 'nodes', 'centroid_lat', 'centroid_lon',
+                                                                           'min_lat', 'min_lon', 'max_lat', 'max_lon'))
+    starts = starts[keep]
+    nodes = np.add.reduceat(found.astype(np.int64), starts)
+    geometry = OrderedDict([('way_id', refs.way_ids.values()[keep]), ('nodes', nodes),
+        ('centroid_lat', np.add.reduceat(np.where(found, lat, 0.0), starts) / np.maximum(nodes, 1)),
+        ('centroid_lon', np.add.reduceat(np.where(found, lon, 0.0), starts) / np.maximum(nodes, 1)),
+        ('min_lat', np.minimum.reduceat(np.where(found, lat, np.inf), starts)),
+        ('min_lon', np.minimum.reduceat(np.where(found, lon, np.inf), starts)),
+        ('max_lat', np.maximum.reduceat(np.where(found, lat, -np.inf), starts)),
+        ('max_lon', np.maximum.reduceat(np.where(found, lon, -np.inf), starts))])
+    located = nodes > 0
+    return OrderedDict((col, values[located]) for col, values in geometry.iteritems())
+
+def write_way_geometry(con, geometry):
+    con.executemany("INSERT OR REPLACE INTO way_geometry VALUES (?,?,?,?,?,?,?,?)",
+                    zip(*[values.tolist() for values in geometry.itervalues()]))
+
+def update_way_geometry(con, way_ids):
+    # same as way_geometry, computed in SQL for the few ways touched by a change file
+    for way_id in way_ids:
+        con.execute("DELETE FROM way_geometry WHERE way_id = ?", (way_id,))
+        con.execute('''INSERT INTO way_geometry SELECT wn.way_id, count(*), avg(n.lat), avg(n.lon), min(n.lat), min(n.lon),
+            max(n.lat), max(n.lon) FROM ways_nodes wn JOIN nodes n ON n.node_id = wn.node_id
+            WHERE wn.way_id = ? AND n.lat IS NOT NULL GROUP BY wn.way_id''', (way_id,))
+
+
+# Relations group nodes, ways and other relations: routes, multipolygons (e.g. buildings with courtyards) and administrative boundaries. The loader stores them in **relations**, **relations_tags** and **relation_members** (relation_id, member_type, member_ref, role, position), in the same pass and through the same batched inserts as the nodes and ways. With **multipolygons=True** it also assembles the rings of every multipolygon and boundary relation: the member ways are joined end to end into closed rings, and the number of outer and inner rings, the area (outer minus inner, in square meters) and the bounding box go to **relation_geometry**. The relations are assembled one at a time, reading only their own ways and nodes from the database, so the memory used does not depend on the size of the file. 
+
+# In[ ]:
+
+relation_geometry_schema = '''CREATE TABLE IF NOT EXISTS relation_geometry (
+    relation_id INTEGER PRIMARY KEY NOT NULL,
+    outer_rings INTEGER,
+    inner_rings INTEGER,
+    complete INTEGER,
+    area FLOAT,
+    min_lat FLOAT,
+    min_lon FLOAT,
+    max_lat FLOAT,
+    max_lon FLOAT);'''
+
+def join_rings(ways):
+    # joins lists of node ids that share their end nodes into rings, returns (closed rings, True if nothing was left open)
+    ways = [list(way) for way in ways if len(way) > 1]
+    rings, complete = [], True
+    while ways:
+        ring = ways.pop()
+        while ring[0] != ring[-1]:
+            for i, way in enumerate(ways):
+                if way[0] == ring[-1]: ring.extend(way[1:])
+                elif way[-1] == ring[-1]: ring.extend(way[-2::-1])
+                else: continue
+                del ways[i]
+                break
+            else:
+                complete = False
+                break
+        if ring[0] == ring[-1]: rings.append(ring)
+    return rings, complete
+
+def ring_area(lats, lons):
+    # area in square meters of a small polygon, projecting the degrees around its first point
+    lat0 = math.radians(lats[0])
+    x = np.radians(np.asarray(lons)) * math.cos(lat0) * earth_radius
+    y = np.radians(np.asarray(lats)) * earth_radius
+    return abs(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2.0
+
+def relation_geometry(con, relation_id):
+    members = con.execute("SELECT member_ref, role FROM relation_members WHERE relation_id = ? AND member_type = 'way' ORDER BY position",
+                          (relation_id,)).fetchall()
+    ways = {'outer': [], 'inner': []}
+    complete = True
+    for way_id, role in members:
+        refs = [row[0] for row in con.execute("SELECT node_id FROM ways_nodes WHERE way_id = ? ORDER BY position", (way_id,))]
+        if not refs: complete = False
+        ways['inner' if role == 'inner' else 'outer'].append(refs)
+    rings = {}
+    for role in ('outer', 'inner'):
+        rings[role], closed = join_rings(ways[role])
+        complete = complete and closed
+    node_ids = list(set(ref for role in rings for ring in rings[role] for ref in ring))
+    coords = {}
+    # in chunks, SQLite limits the number of parameters of a query
+    for start in range(0, len(node_ids), 500):
+        chunk = node_ids[start:start + 500]
+        for node_id, lat, lon in con.execute("SELECT node_id, lat, lon FROM nodes WHERE node_id IN ({})".format(",".join("?" * len(chunk))), chunk):
+            coords[node_id] = (lat, lon)
+    area, points = 0.0, []
+    for role, sign in (('outer', 1), ('inner', -1)):
+        for ring in rings[role]:
+            if any(ref not in coords for ref in ring):
+                complete = False
+                continue
+            lats, lons = [coords[ref][0] for ref in ring], [coords[ref][1] for ref in ring]
+            area += sign * ring_area(lats, lons)
+            points.extend(zip(lats, lons))
+    # relations without a single closed ring are kept as incomplete, without an area or a box
+    if not points: return (relation_id, len(rings['outer']), len(rings['inner']), 0, None, None, None, None, None)
+    lats, lons = zip(*points)
+    return (relation_id, len(rings['outer']), len(rings['inner']), int(complete), max(area, 0.0), min(lats), min(lons), max(lats), max(lons))
+
+def assemble_multipolygons(con, types=("multipolygon", "boundary")):
+    tags_source = "relations_tags_text" if is_interned(con) else "relations_tags"
+    relation_ids = [row[0] for row in con.execute("SELECT DISTINCT relation_id FROM {} WHERE attribute = 'type' AND value IN ({})".format(
+        tags_source, ",".join("?" * len(types))), types)]
+    con.execute("DELETE FROM relation_geometry")
+    for relation_id in relation_ids:
+        con.execute("INSERT INTO relation_geometry VALUES (?,?,?,?,?,?,?,?,?)", relation_geometry(con, relation_id))
+    con.commit()
+    return len(relation_ids)
+
+
+# In[ ]:
+
+load_db('osm.db', replace=True)
+
+
+# OpenStreetMap also publishes daily change files (**.osc**) that list the nodes, ways and relations that were created, modified or deleted. Instead of downloading a new extract and loading everything again, we can apply these changes to the tables that are already in **osm.db**. Every element is matched by its id, and it only replaces what is in the database if its version is newer. If we pass the user counts from **unique_users()** and the dictionaries used by **audit()**, they are updated as well: the old version of an element no longer counts for its user, and the new street names and zip codes are audited. Only the cleaned values are stored in the database, so audit entries of values that disappear with a change stay until the next full **audit()**. 
+
+# In[ ]:
+
+change_actions = ("create", "modify", "delete")
+
+def apply_change(con, action, elem, cleaner, rules, users=None, street_types=None, invalid_zipcodes=None, strings=None,
+                 summary=None, rtree=False, dirty_ways=None):
+    kind = elem.tag
+    table, tags_table, id_col = kind + "s", kind + "s_tags", kind + "_id"
+    elem_id = int(elem.attrib['id'])
+    version = int(elem.attrib.get('version', 0))
+    old = con.execute("SELECT version, user_id, user FROM {} WHERE {} = ?".format(table, id_col), (elem_id,)).fetchone()
+    if old is not None and old[0] is not None and old[0] >= version: return "skipped"
+    # the geometry of a way changes with the way itself or with any of its nodes
+    if dirty_ways is not None:
+        if kind == "way": dirty_ways.add(elem_id)
+        elif kind == "node": dirty_ways.update(row[0] for row in con.execute("SELECT way_id FROM ways_nodes WHERE node_id = ?", (elem_id,)))
+    old_zipcodes = set()
+    if old is not None:
+        tags_source = tags_table + "_text" if strings is not None else tags_table
+        old_rows = con.execute("SELECT attribute, attribute_type, value FROM {} WHERE {} = ?".format(tags_source, id_col),
+                               (elem_id,)).fetchall()
+        old_zipcodes = set(value for attribute, attribute_type, value in old_rows
+                           if attribute == 'postcode' and attribute_type == 'addr')
+        if summary is not None and kind != "relation": summary.add(kind, old[1], old[2], old_rows, -1)
+        con.execute("DELETE FROM {} WHERE {} = ?".format(table, id_col), (elem_id,))
+        con.execute("DELETE FROM {} WHERE {} = ?".format(tags_table, id_col), (elem_id,))
+        if rtree and kind == "node": con.execute("DELETE FROM nodes_rtree WHERE id = ?", (elem_id,))
+        if kind == "way": con.execute("DELETE FROM ways_nodes WHERE way_id = ?", (elem_id,))
+        if kind == "relation": con.execute("DELETE FROM relation_members WHERE relation_id = ?", (elem_id,))
+        if users is not None:
+            uid = str(old[1])
+            users[uid] = users.get(uid, 0) - 1
+            if users[uid] <= 0: del users[uid]
+    if action == "delete": return action if old is not None else "skipped"
+    con.execute(insert_sql(table, db_cols[table]), element_row(elem, kind == "node"))
+    if rtree and kind == "node" and 'lat' in elem.attrib and 'lon' in elem.attrib:
+        lat, lon = float(elem.attrib['lat']), float(elem.attrib['lon'])
+        con.execute("INSERT INTO nodes_rtree VALUES (?,?,?,?,?)", (elem_id, lat, lat, lon, lon))
+    if kind == "way":
+        con.executemany(insert_sql("ways_nodes", db_cols["ways_nodes"]),
+                        [(elem_id, int(nd.attrib['ref']), position) for position, nd in enumerate(elem.iter("nd"))])
+    if kind == "relation":
+        con.executemany(insert_sql("relation_members", db_cols["relation_members"]),
+                        [(elem_id, m.attrib.get('type'), m.attrib.get('ref'), m.attrib.get('role'), position)
+                         for position, m in enumerate(elem.iter("member"))])
+    rows = []
+    for tag in elem.iter("tag"):
+        row = cleaner.clean(tag.attrib['k'], tag.attrib['v'])
+        if row is None: continue
+        rows.append(row)
+        value = row[2]
+        con.execute(insert_sql(tags_table, db_cols[tags_table]), tag_row(elem_id, row, strings))
+        if street_types is not None and is_street_name(tag):
+            rules.audit_street_type(street_types, tag.attrib['v'])
+        # a zip code that was already there before the change has been audited already
+        elif invalid_zipcodes is not None and is_zipcode(tag) and str(value) not in old_zipcodes:
+            rules.audit_zipcode(invalid_zipcodes, tag.attrib['v'])
+    if summary is not None and kind != "relation": summary.add(kind, elem.attrib.get('uid'), elem.attrib.get('user'), rows)
+    if users is not None:
+        uid = elem.attrib.get('uid')
+        users[uid] = users.get(uid, 0) + 1
+    return action
+
+def apply_changes(osc_file, db='osm.db', profile=None, users=None, street_types=None, invalid_zipcodes=None):
+    con = sqlite3.connect(db)
+    con.text_factory = str
+    cleaner = TagCleaner(profile=profile) if profile is not None else tag_cleaner
+    rules = profile or pittsburgh_rules
+    counts = defaultdict(int)
+    try:
+        create_tables(con)
+        # every change looks its element up by id
+        create_indexes(con)
+        strings = StringIds(con) if is_interned(con) else None
+        summary = SummaryCounter(cleaner) if has_summaries(con) else None
+        rtree = has_rtree(con)
+        dirty_ways = set()
+        source, _ = open_osm(osc_file)
+        try:
+            block = None
+            for event, elem in ET.iterparse(source, events=("start", "end")):
+                if event == "start":
+                    if elem.tag in change_actions: block = elem
+                    continue
+                if block is not None and elem.tag in ("node", "way", "relation"):
+                    counts[apply_change(con, block.tag, elem, cleaner, rules, users, street_types, invalid_zipcodes, strings,
+                                        summary, rtree, dirty_ways)] += 1
+                    elem.clear()
+                    del block[:]
+                elif elem.tag in change_actions: block = None
+        finally:
+            source.close()
+        if summary is not None: summary.write(con)
+        update_way_geometry(con, dirty_ways)
+        con.commit()
+        analyze_db(con, full=False)
+    finally:
+        con.close()
+    return dict(counts)
+
+
+# The update_* functions clean one string at a time, and even with the memoized **TagCleaner** every distinct value goes through **re.findall**, **split** and **title** in Python. To clean a whole column at once (a column of a DataFrame, or the value column of a tag table that is already in the database) the batch versions below factorize the column first, clean each distinct value once with the vectorised pandas string methods (**str.extract** for the zip codes, **str.rpartition** and **str.title** for the street names, **map** for the buildings) and broadcast the result back to the rows. **reclean_tags()** re-cleans the value column of a tag DataFrame with the **attribute** and **attribute_type** columns (e.g. from **TagStore**, **read_table()** or an SQL query), and **reclean_db()** does the same in place on the tag tables of **osm.db** and rebuilds the summary tables that depend on the values, so after changing a mapping or a profile we do not have to parse the file again. The database only keeps the cleaned values, so **reclean_db()** starts from those: new street mappings and narrower zip code ranges are applied, and the building categories already assigned are kept. To re-clean from the raw values, build the tags with a cleaner that leaves them as they are, e.g. **TagStore("way", TagCleaner(cleaners={}))**, and pass its DataFrame to **reclean_tags()**. 
+
+# In[ ]:
+
+def unique_apply(values, func):
+    # func gets the distinct values as a Series and returns them cleaned, the result is broadcast back to every row
+    values = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    codes, uniques = pd.factorize(values)
+    out = np.empty(len(values), dtype=object)
+    out[:] = None
+    if len(uniques):
+        cleaned = np.asarray(func(pd.Series(np.asarray(uniques, dtype=object), dtype=object)), dtype=object)
+        found = codes >= 0
+        out[found] = cleaned[codes[found]]
+    return pd.Series(out, index=values.index)
+
+def clean_street_names(names, mapping=None):
+    mapping = mapping_str if mapping is None else mapping
+    def clean(names):
+        head, space, last = [part for _, part in names.str.rpartition(' ').iteritems()]
+        last = last.map(mapping).where(last.isin(mapping.keys()), last)
+        return (head + space + last).str.title()
+    return unique_apply(names, clean)
+
+def clean_zipcodes(zipcodes, ranges=None):
+    ranges = ZipRanges([(15001, 16263)]) if ranges is None else ranges
+    def clean(zipcodes):
+        digits = pd.to_numeric(zipcodes.map(as_text).str.extract(r'(\d+)', expand=False), errors='coerce')
+        valid = digits.notnull().values
+        valid[valid] = ranges.contains(digits.values[valid])
+        out = np.empty(len(zipcodes), dtype=object)
+        out[:] = "0"
+        out[valid] = digits.values[valid].astype(np.int64).astype(object)
+        return out
+    return unique_apply(zipcodes, clean)
+
+def clean_landuse(buildings, mapping=None, default="other"):
+    mapping = mapping_bld if mapping is None else mapping
+    def clean(buildings):
+        return buildings.map(mapping).where(buildings.isin(mapping.keys()), default)
+    return unique_apply(buildings, clean)
+
+# the batch version of tag_cleaners (or of profile.cleaners()), cleaned=True for values that were cleaned before
+def batch_cleaners(profile=None, cleaned=False):
+    if profile is None: str_map, zipcodes, bld_map, default = mapping_str, None, mapping_bld, "other"
+    else: str_map, zipcodes, bld_map, default = profile.mapping_str, profile.zipcodes, profile.mapping_bld, profile.default_landuse
+    if cleaned:
+        # a building category is not a key of the mapping, it would turn into the default otherwise
+        bld_map = dict(bld_map)
+        for category in set(bld_map.values()) | set([default]): bld_map.setdefault(category, category)
+    return {"addr:postcode": lambda values: clean_zipcodes(values, zipcodes),
+            "addr:street": lambda values: clean_street_names(values, str_map),
+            "building": lambda values: clean_landuse(values, bld_map, default)}
+
+def reclean_tags(df, cleaners=None, profile=None, column="value"):
+    cleaners = cleaners or batch_cleaners(profile)
+    df = df.copy()
+    values = df[column].astype(object)
+    attribute_types = df['attribute_type'].astype(object).fillna('NA')
+    for key, clean in cleaners.iteritems():
+        attribute, attribute_type = split_key(key)
+        rows = ((df['attribute'] == attribute) & (attribute_types == (attribute_type or 'NA'))).values
+        if rows.any(): values[rows] = clean(values[rows]).values
+    df[column] = values
+    return df
+
+# postcode_counts, building_counts and zipcode_buildings counted again from the tag tables
+def rebuild_value_summaries(con, interned=False):
+    nodes_tags, ways_tags = ("nodes_tags_text", "ways_tags_text") if interned else ("nodes_tags", "ways_tags")
+    for table in ('postcode_counts', 'building_counts', 'zipcode_buildings'): con.execute("DELETE FROM {}".format(table))
+    con.execute("INSERT INTO postcode_counts (postcode, count) SELECT value, COUNT(*) FROM "
+                "(SELECT value FROM {0} WHERE attribute = 'postcode' UNION ALL SELECT value FROM {1} WHERE attribute = 'postcode') "
+                "GROUP BY value;".format(nodes_tags, ways_tags))
+    con.execute("INSERT INTO building_counts (building, count) SELECT value, COUNT(*) FROM {0} "
+                "WHERE attribute = 'building' GROUP BY value;".format(ways_tags))
+    con.execute("INSERT INTO zipcode_buildings (zipcode, building, count) SELECT z.value, b.value, COUNT(*) FROM {0} z "
+                "JOIN {0} b ON b.way_id = z.way_id WHERE z.attribute = 'postcode' AND b.attribute = 'building' "
+                "GROUP BY z.value, b.value;".format(ways_tags))
+
+def reclean_db(db='osm.db', profile=None, cleaners=None):
+    con = sqlite3.connect(db)
+    con.text_factory = str
+    cleaners = cleaners or batch_cleaners(profile, cleaned=True)
+    counts = defaultdict(int)
+    try:
+        create_tables(con)
+        strings = StringIds(con) if is_interned(con) else None
+        for table, _ in tag_tables:
+            source = table + "_text" if strings is not None else table
+            for key, clean in cleaners.iteritems():
+                attribute, attribute_type = split_key(key)
+                rows = con.execute("SELECT id, value FROM {} WHERE attribute = ? AND attribute_type = ?".format(source),
+                                   (attribute, attribute_type or 'NA')).fetchall()
+                if not rows: continue
+                ids, values = zip(*rows)
+                new_values = clean(pd.Series(values, dtype=object))
+                # only the rows whose value changes are written back
+                changed = [(strings(value) if strings is not None else value, row_id)
+                           for row_id, old, value in zip(ids, values, new_values) if as_text(value) != old]
+                con.executemany("UPDATE {} SET value = ? WHERE id = ?".format(table), changed)
+                counts[table] += len(changed)
+        if has_summaries(con): rebuild_value_summaries(con, strings is not None)
+        con.commit()
+    finally:
+        con.close()
+    return dict(counts)
+
+
 # **FILE SIZES**: we now define a function to loop through all our files that we have created so far and report their sizes. The original OSM file is the largest and the size has shrinked after making our databases. Mostly because we didn't include all the tags. The largest CSV file is the "nodes.csv". 
 # 
 # * file 'nodes.csv' is 172.6 MB
@@ -480,16 +2888,166 @@ for i in files_lst:
 
 # # Analyzing the Data Using SQL
 
-# In this section I will try to answer some questions via SQL queries. First we define a couple functions to simplify the querying and plotting process:
+# In this section I will try to answer some questions via SQL queries. Each question is answered from the summary tables that the loader filled in, and the query over the full tables that gives the same answer is kept as a comment. First we define a couple functions to simplify the querying and plotting process:
+
+# The same few questions are asked over and over, from this notebook, from other notebooks and from a dashboard, and each of them used to open its own connection and run its GROUP BY again. **QueryService** keeps a small pool of read-only connections to **osm.db** (**PRAGMA query_only**) that any number of threads can share, and caches the results of the queries. The cache is keyed on the data version of the database: a separate connection watches **PRAGMA data_version**, which changes whenever another connection commits, e.g. **load_db()**, **apply_changes()** or **reclean_db()**, and all cached results are dropped when it does. The common analyses are named in **analysis_queries** with their parameters and defaults, e.g. **analysis.run("zipcode_buildings", building="commercial", limit=10)**; they read the summary tables when the loader made them and the full tables otherwise. **serve()** makes the service available over HTTP on this machine (**GET /zipcode_buildings?building=commercial** returns the rows as JSON), so other processes share the same warm cache through **remote_run()**. 
 
 # In[559]:
 
+# every analysis: (query on the summary tables, the same query on the full tables, default parameters)
+analysis_queries = OrderedDict([
+    ("top_users", ("SELECT user,user_id,count FROM user_counts order by count Desc limit :limit;",
+                   '''SELECT user,user_id,sum(n) FROM
+                      (SELECT user_id,user,count(*) as n FROM nodes group by user_id
+                       UNION ALL
+                       SELECT user_id,user,count(*) as n FROM ways group by user_id)
+                      group by user_id order by sum(n) Desc limit :limit;''', {'limit': 30})),
+    ("postcode_counts", ("SELECT postcode,count FROM postcode_counts order by count Desc limit :limit;",
+                         '''SELECT value,count(*) FROM
+                            (SELECT value FROM {ways_tags} where attribute ='postcode'
+                             UNION ALL
+                             SELECT value FROM {nodes_tags} where attribute ='postcode')
+                            group by value order by count(*) Desc limit :limit;''', {'limit': 30})),
+    ("attribute_types", ("SELECT attribute_type,count FROM attribute_type_counts order by count Desc limit :limit;",
+                         '''SELECT attribute_type,count(*) FROM
+                            (SELECT attribute_type FROM {ways_tags}
+                             UNION ALL
+                             SELECT attribute_type FROM {nodes_tags})
+                            group by attribute_type order by count(*) Desc limit :limit;''', {'limit': 30})),
+    ("building_counts", ("SELECT building,count FROM building_counts order by count Desc limit :limit;",
+                         "SELECT value,count(*) FROM {ways_tags} where attribute ='building' group by value order by count(*) Desc limit :limit;",
+                         {'limit': 8})),
+    ("zipcode_buildings", ("SELECT zipcode,building,count FROM zipcode_buildings WHERE building = :building order by count Desc limit :limit;",
+                           '''SELECT zipcodes.value,buildings.value, count(buildings.value) as count FROM
+                              (SELECT * FROM {ways_tags} WHERE attribute ='building') as buildings join
+                              (SELECT * FROM {ways_tags} WHERE attribute ='postcode') as zipcodes on buildings.way_id = zipcodes.way_id
+                              WHERE buildings.value = :building group by zipcodes.value order by count(buildings.value) Desc limit :limit;''',
+                           {'building': 'residential', 'limit': 10}))])
+
+class QueryService(object):
+    def __init__(self, db='osm.db', pool_size=4, cache_size=256, timeout=30.0):
+        self.db = db
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pool = Queue.Queue()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.cache = LRUCache(cache_size)
+        self.hits = self.misses = 0
+        # only used to notice commits from other connections, under the lock
+        self.watcher = self.connect()
+        self.version = self.watcher.execute("PRAGMA data_version").fetchone()[0]
+        self.generation = 0
+    def connect(self):
+        con = sqlite3.connect(self.db, timeout=self.timeout, check_same_thread=False)
+        con.text_factory = str
+        con.execute("PRAGMA query_only = ON")
+        return con
+    @contextmanager
+    def connection(self):
+        try:
+            con = self.pool.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                con = self.connect() if len(self.connections) < self.pool_size else None
+                if con is not None: self.connections.append(con)
+            # all the connections are busy, wait for one to come back
+            if con is None: con = self.pool.get()
+        try:
+            yield con
+        finally:
+            self.pool.put(con)
+    # returns the current generation of the cache, a new one when the data changed since the last call
+    def check(self):
+        with self.lock:
+            version = self.watcher.execute("PRAGMA data_version").fetchone()[0]
+            if version != self.version:
+                self.version = version
+                self.generation += 1
+                self.cache.clear()
+            return self.generation
+    def cached(self, key, compute):
+        generation = self.check()
+        with self.lock:
+            rows = self.cache.get((generation, key))
+            if rows is not None: self.hits += 1
+            else: self.misses += 1
+        if rows is None:
+            with self.connection() as con: rows = compute(con)
+            with self.lock:
+                # rows read while the data changed are not kept
+                if self.generation == generation: self.cache.put((generation, key), rows)
+        return list(rows)
+    def query(self, sql, params=()):
+        key = (sql, tuple(sorted(params.items())) if isinstance(params, dict) else tuple(params))
+        return self.cached(key, lambda con: con.execute(sql, params).fetchall())
+    def run(self, name, **params):
+        summary_sql, full_sql, defaults = analysis_queries[name]
+        params = dict(defaults, **params)
+        def compute(con):
+            if has_summaries(con): sql = summary_sql
+            else:
+                suffix = "_text" if is_interned(con) else ""
+                sql = full_sql.format(nodes_tags="nodes_tags" + suffix, ways_tags="ways_tags" + suffix)
+            return con.execute(sql, params).fetchall()
+        return self.cached((name, tuple(sorted(params.items()))), compute)
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'generation': self.generation, 'connections': len(self.connections)}
+    def close(self):
+        with self.lock:
+            for con in self.connections + [self.watcher]: con.close()
+            self.connections = []
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # GET /<analysis>?<parameter>=<value> runs the analysis, GET /stats reports the cache
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        name = url.path.strip("/")
+        params = dict((key, int(value) if value.isdigit() else value) for key, value in urlparse.parse_qsl(url.query))
+        try:
+            if name == "stats": body = self.server.service.stats()
+            elif name in analysis_queries: body = {'rows': self.server.service.run(name, **params)}
+            else:
+                self.send_error(404, "unknown analysis {!r}".format(name))
+                return
+        except sqlite3.Error as e:
+            self.send_error(500, str(e))
+            return
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    def log_message(self, format, *args):
+        pass
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(service, host="127.0.0.1", port=8765, background=True):
+    server = QueryServer((host, port), QueryHandler)
+    server.service = service
+    if not background:
+        server.serve_forever()
+        return server
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def remote_run(name, url="http://127.0.0.1:8765", **params):
+    response = urllib2.urlopen("{}/{}?{}".format(url.rstrip("/"), name, urllib.urlencode(params)))
+    try:
+        return [tuple(row) for row in json.load(response)['rows']]
+    finally:
+        response.close()
+
 # we generated the following tables: ways,ways_tags,nodes,nodes_tags
-con = sqlite3.connect('osm.db')
-con.text_factory = str
-cur = con.cursor()
-def quer(a):
-    return cur.execute(a).fetchall()
+# one service for the whole notebook, the queries below are answered from its cache when they are run again
+analysis = QueryService('osm.db')
+def quer(a, params=()):
+    return analysis.query(a, params)
 
 def barplot_quer (m,a,b):
     get_ipython().magic(u'matplotlib inline')
@@ -507,11 +3065,14 @@ def barplot_quer (m,a,b):
 # In[560]:
 
 # top 30 contributing users
-m = quer('''SELECT user,user_id,count(*) FROM   
-     (SELECT user_id,user FROM nodes
-      UNION ALL
-      SELECT user_id,user FROM ways)    
-     nodes group by user_id order by count(*) Desc limit 30;''')
+# each table is counted on its (user_id, user) index first, then the two counts are added up
+# m = quer('''SELECT user,user_id,sum(n) FROM
+#      (SELECT user_id,user,count(*) as n FROM nodes group by user_id
+#       UNION ALL
+#       SELECT user_id,user,count(*) as n FROM ways group by user_id)
+#      group by user_id order by sum(n) Desc limit 30;''')
+# the loader has already counted them in the user_counts summary table
+m = analysis.run("top_users", limit=30)
 barplot_quer (m,2,0)
 plt.xlabel('users', fontsize=14)
 plt.ylabel('number of contributions', fontsize=14)
@@ -522,11 +3083,12 @@ plt.title('Top contributing users in Pittsburgh', fontsize=17)
 
 # In[561]:
 
-m = quer('''SELECT value,count(*) FROM 
-         (SELECT * FROM ways_tags
-         UNION ALL
-         SELECT * FROM nodes_tags)
-         where attribute ='postcode' group by value order by count(*) Desc limit 30;''')
+# m = quer('''SELECT value,count(*) FROM 
+#          (SELECT value FROM ways_tags where attribute ='postcode'
+#          UNION ALL
+#          SELECT value FROM nodes_tags where attribute ='postcode')
+#          group by value order by count(*) Desc limit 30;''')
+m = analysis.run("postcode_counts", limit=30)
 barplot_quer (m,1,0)
 plt.xlabel('zip code', fontsize=14)
 plt.ylabel('count', fontsize=14)
@@ -537,11 +3099,12 @@ plt.title('Number of contributions per zip code', fontsize=17)
 
 # In[562]:
 
-m = quer('''SELECT attribute_type,count(*) FROM 
-         (SELECT attribute_type FROM ways_tags
-         UNION ALL
-         SELECT attribute_type FROM nodes_tags)
-         group by attribute_type order by count(*) Desc limit 30;''')
+# m = quer('''SELECT attribute_type,count(*) FROM 
+#          (SELECT attribute_type FROM ways_tags
+#          UNION ALL
+#          SELECT attribute_type FROM nodes_tags)
+#          group by attribute_type order by count(*) Desc limit 30;''')
+m = analysis.run("attribute_types", limit=30)
 barplot_quer (m,1,0)
 plt.xlabel('attribute type', fontsize=14)
 plt.ylabel('count', fontsize=14)
@@ -551,7 +3114,8 @@ plt.title('Types of attributes found in Pittsburgh OSM', fontsize=17)
 
 # In[563]:
 
-m = quer("SELECT value,count(*) FROM ways_tags where attribute ='building' group by value order by count(*) Desc limit 8;")
+# m = quer("SELECT value,count(*) FROM ways_tags where attribute ='building' group by value order by count(*) Desc limit 8;")
+m = analysis.run("building_counts", limit=8)
 barplot_quer (m,1,0)
 plt.xlabel('land use type', fontsize=14)
 plt.ylabel('count', fontsize=14)
@@ -560,12 +3124,10 @@ plt.title('Land use count in Pittsburgh', fontsize=17)
 
 # In[567]:
 
-quer("CREATE TABLE zipcodes AS SELECT * FROM ways_tags WHERE attribute ='postcode';")
-quer("CREATE TABLE buildings AS SELECT * FROM ways_tags WHERE attribute ='building';")
-
-m = quer('''SELECT zipcodes.value,buildings.value, count(buildings.value) 
-            as count FROM buildings join zipcodes on buildings.way_id = zipcodes.way_id 
-            WHERE buildings.value == 'residential' group by zipcodes.value order by count(buildings.value) Desc limit 10;''')
+# m = quer('''SELECT zipcodes.value,buildings.value, count(buildings.value) 
+#             as count FROM buildings join zipcodes on buildings.way_id = zipcodes.way_id 
+#             WHERE buildings.value == 'residential' group by zipcodes.value order by count(buildings.value) Desc limit 10;''')
+m = analysis.run("zipcode_buildings", building="residential", limit=10)
 barplot_quer (m,2,0)
 plt.xlabel('zip code', fontsize=14)
 plt.ylabel('count', fontsize=14)
@@ -574,15 +3136,306 @@ plt.title('Number of residential buildings per zip code', fontsize=17)
 
 # In[568]:
 
-m = quer('''SELECT zipcodes.value,buildings.value, count(buildings.value) 
-            as count FROM buildings join zipcodes on buildings.way_id = zipcodes.way_id 
-            WHERE buildings.value == 'commercial' group by zipcodes.value order by count(buildings.value) Desc limit 10;''')
+# m = quer('''SELECT zipcodes.value,buildings.value, count(buildings.value) 
+#             as count FROM buildings join zipcodes on buildings.way_id = zipcodes.way_id 
+#             WHERE buildings.value == 'commercial' group by zipcodes.value order by count(buildings.value) Desc limit 10;''')
+m = analysis.run("zipcode_buildings", building="commercial", limit=10)
 barplot_quer (m,2,0)
 plt.xlabel('zip code', fontsize=14)
 plt.ylabel('count', fontsize=14)
 plt.title('Number of commercial buildings per zip code', fontsize=17)
 
 
+# # Benchmarking the Pipeline
+# 
+# The file sizes above are the only numbers we had about the cost of this analysis. To know whether a change to the cleaning or loading code makes it faster or slower, we need to run the same stages on the same data every time. **synthetic_osm()** writes an OSM file of any size: nodes around Pittsburgh, ways made of those nodes and multipolygon relations made of those ways, with tags drawn from **synthetic_keys**, a list of (key, weight, values) where the weights set how often each key is used. Everything comes from a random generator seeded with **seed**, so the same arguments always give the same file. **benchmark()** then times each stage in **benchmark_stages** (the tag count, the audit, the four tables, loading the database and the analysis queries) and reports the elements and megabytes per second and the peak memory of each stage. The peak is the memory a stage adds on top of what its process already held: a forked process inherits the high-water mark of its parent, so **reset_peak_rss()** resets it through /proc/self/clear_refs before the stage and the peak is read back from /proc/self/status after it (on systems without /proc the peak is left empty). With **isolate=True** every stage runs in its own process, so one stage does not leave memory behind for the next one. Every run is appended to **benchmarks.jsonl** under a **label**, and **compare_benchmarks()** puts two runs side by side and flags the stages that got slower. 
+
+# In[ ]:
+
+street_bases = ["Forbes", "Fifth", "Penn", "Liberty", "Butler", "Murray", "Centre", "Walnut", "Carson", "Smithfield",
+                "Grant", "Negley", "Highland", "Baum", "Ellsworth", "Braddock", "Brownsville", "Saw Mill Run", "Allegheny River", "Ohio River"]
+street_suffixes = ["Avenue", "Street", "Road", "Boulevard", "Drive", "Way", "Ave", "Ave.", "St", "St.", "Rd", "Blvd", "Dr", "Ln", "Pike", "Extension"]
+synthetic_keys = [
+    ("addr:street", 20, [base + " " + suffix for base in street_bases for suffix in street_suffixes]),
+    ("addr:housenumber", 20, [str(number) for number in range(1, 400)]),
+    ("addr:postcode", 20, [str(zipcode) for zipcode in range(15201, 15244)] + ["15213-3890", "PA 15217", "1521", "44101", "Pittsburgh"]),
+    ("addr:city", 10, ["Pittsburgh", "pittsburgh", "Pittsburgh, PA"]),
+    ("addr:state", 5, ["PA", "pa", "Pennsylvania"]),
+    ("building", 15, sorted(mapping_bld) + ["yes", "residential", "commercial", "roof", "shed"]),
+    ("highway", 10, ["residential", "service", "footway", "primary", "secondary", "traffic_signals", "crossing"]),
+    ("name", 10, ["Cafe", "Church", "Library", "Market", "Park", "School"]),
+    ("amenity", 5, ["restaurant", "parking", "bench", "school", "place_of_worship", "fuel"]),
+    ("tiger:county", 5, ["Allegheny, PA"]),
+    ("tiger:cfcc", 3, ["A41", "A21"]),
+    ("source", 5, ["bing", "survey", "tiger_import_dch_v0.6_20070809"])]
+
+def synthetic_osm(filename, nodes=100000, ways=None, relations=None, node_tags=0.3, way_tags=3, way_nodes=6, keys=None,
+                  users=500, seed=0):
+    if ways is None: ways = nodes // 8
+    if relations is None: relations = ways // 50
+    keys = synthetic_keys if keys is None else keys
+    rng = random.Random(seed)
+    cumulative = list(np.cumsum([weight for _, weight, _ in keys]))
+    def tags(mean):
+        # on average mean tags per element, without repeating a key
+        chosen = {}
+        for _ in range(int(2 * mean * rng.random() + 0.5)):
+            key, _, values = keys[bisect.bisect_right(cumulative, rng.random() * cumulative[-1])]
+            chosen[key] = rng.choice(values)
+        return "".join('\n  <tag k=%s v=%s/>' % (quoteattr(k), quoteattr(v)) for k, v in sorted(chosen.iteritems()))
+    def attributes(elem_id):
+        uid = rng.randint(1, users)
+        return 'id="%d" version="%d" timestamp="2016-%02d-%02dT%02d:%02d:00Z" changeset="%d" uid="%d" user="user_%d"' % (
+            elem_id, rng.randint(1, 5), rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59),
+            rng.randint(1, 50000), uid, uid)
+    out = open(filename, "w")
+    try:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="synthetic_osm">\n')
+        for node_id in xrange(1, nodes + 1):
+            body = tags(node_tags)
+            out.write(' <node %s lat="%.7f" lon="%.7f"%s\n' % (attributes(node_id), rng.uniform(40.36, 40.50), rng.uniform(-80.10, -79.86),
+                                                           '>' + body + '\n </node>' if body else '/>'))
+        for way_id in xrange(1, ways + 1):
+            start = rng.randint(1, max(nodes - way_nodes, 1))
+            refs = range(start, min(start + rng.randint(2, 2 * way_nodes - 2), nodes + 1))
+            # about a third of the ways are closed, like buildings
+            if rng.random() < 0.3: refs.append(refs[0])
+            out.write(' <way %s>%s%s\n </way>\n' % (attributes(way_id), "".join('\n  <nd ref="%d"/>' % ref for ref in refs), tags(way_tags)))
+        for relation_id in xrange(1, relations + 1):
+            members = [rng.randint(1, ways) for _ in range(rng.randint(1, 3))]
+            out.write(' <relation %s>%s\n  <tag k="type" v="multipolygon"/>\n </relation>\n' % (attributes(relation_id), "".join(
+                '\n  <member type="way" ref="%d" role="%s"/>' % (ref, "outer" if i == 0 else "inner") for i, ref in enumerate(members))))
+        out.write('</osm>\n')
+    finally:
+        out.close()
+    return {'nodes': nodes, 'ways': ways, 'relations': relations, 'bytes': os.path.getsize(filename)}
+
+
+# In[ ]:
+
+benchmark_queries = [
+    "SELECT user,user_id,count FROM user_counts order by count Desc limit 30;",
+    "SELECT postcode,count FROM postcode_counts order by count Desc limit 30;",
+    "SELECT attribute_type,count FROM attribute_type_counts order by count Desc limit 30;",
+    "SELECT building,count FROM building_counts order by count Desc limit 8;",
+    "SELECT zipcode,building,count FROM zipcode_buildings WHERE building == 'residential' order by count Desc limit 10;"]
+# the same questions answered from the full tables
+benchmark_full_queries = [
+    '''SELECT user,user_id,sum(n) FROM
+       (SELECT user_id,user,count(*) as n FROM nodes group by user_id
+        UNION ALL
+        SELECT user_id,user,count(*) as n FROM ways group by user_id)
+       group by user_id order by sum(n) Desc limit 30;''',
+    '''SELECT value,count(*) FROM
+       (SELECT value FROM ways_tags where attribute ='postcode'
+        UNION ALL
+        SELECT value FROM nodes_tags where attribute ='postcode')
+       group by value order by count(*) Desc limit 30;''',
+    '''SELECT attribute_type,count(*) FROM
+       (SELECT attribute_type FROM ways_tags
+        UNION ALL
+        SELECT attribute_type FROM nodes_tags)
+       group by attribute_type order by count(*) Desc limit 30;''',
+    "SELECT value,count(*) FROM ways_tags where attribute ='building' group by value order by count(*) Desc limit 8;",
+    '''SELECT zipcodes.value,buildings.value, count(buildings.value) as count FROM
+       (SELECT * FROM ways_tags WHERE attribute ='building') as buildings join
+       (SELECT * FROM ways_tags WHERE attribute ='postcode') as zipcodes on buildings.way_id = zipcodes.way_id
+       WHERE buildings.value == 'residential' group by zipcodes.value order by count(buildings.value) Desc limit 10;''']
+
+def run_queries(db, queries):
+    con = sqlite3.connect(db)
+    try:
+        return [con.execute(query).fetchall() for query in queries]
+    finally:
+        con.close()
+
+# every stage gets the OSM file and the database, the database stages expect load_db to have run before them
+benchmark_stages = OrderedDict([
+    ("tag_count", lambda filename, db: run_pass([TagCounter()], filename)),
+    ("audit", lambda filename, db: run_pass([Auditor(defaultdict(set), defaultdict(int))], filename)),
+    ("nodes_table", lambda filename, db: run_pass([ElementTable("node", node_cols)], filename)),
+    ("ways_table", lambda filename, db: run_pass([ElementTable("way", way_cols)], filename)),
+    ("nodes_tags_table", lambda filename, db: run_pass([TagsTable("node")], filename)),
+    ("ways_tags_table", lambda filename, db: run_pass([TagsTable("way")], filename)),
+    ("load_db", lambda filename, db: load_db(db, filename, replace=True)),
+    ("queries", lambda filename, db: run_queries(db, benchmark_queries)),
+    ("full_queries", lambda filename, db: run_queries(db, benchmark_full_queries))])
+
+def memory_status():
+    # the Vm* lines of /proc/self/status in kB, None where there is no /proc
+    try:
+        with open("/proc/self/status") as status:
+            return dict((line.split(":")[0], int(line.split()[1])) for line in status if line.startswith("Vm"))
+    except (IOError, OSError): return None
+
+def reset_peak_rss():
+    # a forked worker starts with the high-water mark of its parent, so ru_maxrss says nothing about the stage it runs.
+    # Linux resets the mark (VmHWM) to the current resident memory, which is returned as the baseline in kB
+    try:
+        with open("/proc/self/clear_refs", "w") as out: out.write("5")
+    except (IOError, OSError): return None
+    status = memory_status()
+    return status.get("VmRSS") if status else None
+
+def benchmark_stage(job):
+    # the peak is the memory the stage added on top of what the process already held, None if it can't be measured
+    name, filename, db = job
+    baseline = reset_peak_rss()
+    start = time.time()
+    benchmark_stages[name](filename, db)
+    seconds = time.time() - start
+    status = memory_status() if baseline is not None else None
+    return seconds, (status["VmHWM"] - baseline) / 1024.0 if status and "VmHWM" in status else None
+
+def benchmark(filename=None, db="benchmark.db", stages=None, repeat=1, isolate=True, label=None, results="benchmarks.jsonl"):
+    if filename is None: filename = osm_file
+    if stages is None: stages = list(benchmark_stages)
+    counts = run_pass([TagCounter()], filename)[0]
+    elements = sum(counts.get(tag, 0) for tag in ("node", "way", "relation"))
+    megabytes = os.path.getsize(filename) / (1024 * 1024.0)
+    record = OrderedDict([("label", label or time.strftime("%Y-%m-%d %H:%M:%S")), ("time", time.time()),
+                          ("python", sys.version.split()[0]), ("platform", platform.platform()), ("file", os.path.basename(filename)),
+                          ("backend", xml_backend), ("megabytes", megabytes), ("elements", elements), ("stages", OrderedDict())])
+    for name in stages:
+        runs = []
+        for _ in range(repeat):
+            if isolate:
+                pool = multiprocessing.Pool(1)
+                try:
+                    runs.append(pool.apply(benchmark_stage, ((name, filename, db),)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else: runs.append(benchmark_stage((name, filename, db)))
+        # the fastest run is the one least disturbed by everything else running on the machine
+        seconds = min(run[0] for run in runs)
+        peaks = [run[1] for run in runs if run[1] is not None]
+        record["stages"][name] = OrderedDict([("seconds", seconds), ("elements_per_s", elements / seconds if seconds else None),
+                                              ("mb_per_s", megabytes / seconds if seconds else None),
+                                              ("peak_rss_mb", max(peaks) if peaks else None)])
+        print "{:<18}{:>10.2f} s{:>14,.0f} elements/s{:>10.1f} MB/s{:>10} MB peak".format(
+            name, seconds, record["stages"][name]["elements_per_s"] or 0, record["stages"][name]["mb_per_s"] or 0,
+            "?" if not peaks else int(max(peaks)))
+    if results is not None:
+        with open(results, "a") as out: out.write(json.dumps(record) + "\n")
+    return record
+
+def load_benchmarks(results="benchmarks.jsonl"):
+    with open(results) as source: return [json.loads(line, object_pairs_hook=OrderedDict) for line in source if line.strip()]
+
+def compare_benchmarks(baseline=None, current=None, results="benchmarks.jsonl", tolerance=0.1):
+    # baseline and current are labels, by default the last two runs are compared
+    records = load_benchmarks(results)
+    by_label = dict((record["label"], record) for record in records)
+    old = by_label[baseline] if baseline is not None else records[-2]
+    new = by_label[current] if current is not None else records[-1]
+    rows = []
+    for name, stage in new["stages"].iteritems():
+        if name not in old["stages"]: continue
+        before = old["stages"][name]
+        ratio = stage["seconds"] / before["seconds"] if before["seconds"] else None
+        rows.append((name, before["seconds"], stage["seconds"], ratio, before["peak_rss_mb"], stage["peak_rss_mb"],
+                     ratio is not None and ratio > 1 + tolerance))
+    return pd.DataFrame(rows, columns=["stage", "seconds_before", "seconds_after", "ratio", "peak_rss_before", "peak_rss_after",
+                                       "regression"]).set_index("stage")
+
+
+# In[ ]:
+
+# a file of about 100 MB, run once before and once after changing the pipeline
+# synthetic_osm("synthetic.osm", nodes=600000)
+# benchmark("synthetic.osm", label="before")
+# benchmark("synthetic.osm", label="after")
+# compare_benchmarks("before", "after")
+# check_backends([ElementTable("node", node_cols), ElementTable("way", way_cols), TagsTable("node"), TagsTable("way")], "synthetic.osm")
+
+
+# **check_backends()** is also run on every execution of this notebook, on a small file that holds what the backends are most likely to disagree on: escaped and non ASCII values, elements without children or without some attributes, keys with problem characters, the <nd> and <member> children and the values the cleaners change, together with a small synthetic file. Every available backend has to give the same tag counts, users, keys, audit, tables and loader rows as cElementTree. 
+
+# In[ ]:
+
+backend_fixture = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="fixture">
+ <bounds minlat="40.36" minlon="-80.1" maxlat="40.5" maxlon="-79.86"/>
+ <node id="1" lat="40.4406" lon="-79.9959" version="2" changeset="10" user="Ann &amp; Bob" uid="7" timestamp="2016-01-02T03:04:05Z"/>
+ <node id="2" lat="-0.0000001" lon="0" version="1" changeset="11" user="Jos\xc3\xa9" uid="8" timestamp="2016-01-02T03:04:06Z">
+  <tag k="addr:street" v="Forbes Ave"/>
+  <tag k="addr:postcode" v="PA 15213-1234"/>
+  <tag k="name" v="Caf\xc3\xa9 &quot;Lou&quot; &lt;&gt;"/>
+  <tag k="bad key" v="problem chars"/>
+ </node>
+ <node id="3" lat="40.45" lon="-80.0" version="1" changeset="11" uid="8" timestamp="2016-01-02T03:04:07Z">
+  <tag k="addr:postcode" v="99999"/>
+ </node>
+ <way id="10" version="1" changeset="12" user="Ann &amp; Bob" uid="7" timestamp="2016-01-03T00:00:00Z">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <nd ref="3"/>
+  <nd ref="1"/>
+  <tag k="building" v="house"/>
+  <tag k="addr:street" v="Murray st."/>
+  <tag k="tiger:county" v="Allegheny, PA"/>
+ </way>
+ <way id="11" version="1" changeset="12" user="Ann &amp; Bob" uid="7" timestamp="2016-01-03T00:00:01Z">
+  <nd ref="2"/>
+ </way>
+ <relation id="20" version="1" changeset="13" user="Jos\xc3\xa9" uid="8" timestamp="2016-01-04T00:00:00Z">
+  <member type="way" ref="10" role="outer"/>
+  <member type="node" ref="3" role=""/>
+  <tag k="type" v="multipolygon"/>
+ </relation>
+</osm>
+'''
+
+class CollectRows(object):
+    # stands in for a DBWriter and keeps the rows the loader visitors would insert
+    def __init__(self):
+        self.rows = defaultdict(list)
+    def add(self, table, row):
+        self.rows[table].append(row)
+
+def fixture_visitors():
+    writer = CollectRows()
+    loader = [ElementRows("node", writer), ElementRows("way", writer), TagsRows("node", writer), TagsRows("way", writer),
+              ElementRows("relation", writer), TagsRows("relation", writer), MemberRows(writer), WayRefs(writer)]
+    return [TagCounter(), UserCounter(), KeyCounter(), Auditor(defaultdict(set), defaultdict(int)), ElementTable("node", node_cols),
+            ElementTable("way", way_cols), TagsTable("node"), TagsTable("way")], loader, writer
+
+def check_backend_fixture(text=backend_fixture):
+    # check_backends() for the plain visitors, the loader visitors are compared on the rows they write
+    handle, path = tempfile.mkstemp(suffix=".osm")
+    try:
+        with os.fdopen(handle, "w") as out: out.write(text)
+        visitors, _, _ = fixture_visitors()
+        names = check_backends(visitors, path)
+        expected = None
+        for name in names:
+            _, loader, writer = fixture_visitors()
+            run_pass(loader, path, backend=name)
+            rows = dict((table, [tuple(as_text(value) for value in row) for row in table_rows])
+                        for table, table_rows in writer.rows.iteritems())
+            if expected is None: expected = rows
+            elif rows != expected: raise AssertionError("the loader writes different rows with backend {!r}".format(name))
+        return names
+    finally:
+        os.remove(path)
+
+def check_synthetic_backends(nodes=2000):
+    handle, path = tempfile.mkstemp(suffix=".osm")
+    os.close(handle)
+    try:
+        synthetic_osm(path, nodes=nodes)
+        with open(path) as source: return check_backend_fixture(source.read())
+    finally:
+        os.remove(path)
+
+
+# In[ ]:
+
+check_backend_fixture()
+check_synthetic_backends()
+
+
 # # Conclusion and Other Ideas
 # 
 # 